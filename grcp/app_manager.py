@@ -1,9 +1,11 @@
 """
 Application management framework (inspired by Ryu application framework).
 New application to be created by inherit the class AppBase
+
+The standard library is expected to be monkey patched by eventlet before this module
+is imported; this is done once by the program entry point (grcp.grcp).
 """
 import eventlet
-eventlet.monkey_patch()
 
 import importlib
 import inspect
@@ -14,6 +16,12 @@ import greenlet
 
 logger = logging.getLogger('grcp')
 
+_EMPTY_HANDLERS = ()
+
+# every long running green thread of the apps and the controller is spawned from
+# this pool; the bound caps how many greenlets the hub has to schedule
+_POOL = eventlet.GreenPool(256)
+
 def spawn(*args, **kwargs):
     # taken from ryu.lib.hub
     def _launch(func, *args, **kwargs):
@@ -22,76 +30,116 @@ def spawn(*args, **kwargs):
         except greenlet.GreenletExit:
             pass
         except BaseException as e:
-            print('hub: uncaught exception: %s', traceback.format_exc())
+            logger.error('hub: uncaught exception: %s', traceback.format_exc())
 
-    return eventlet.spawn(_launch, *args, **kwargs)
+    return _POOL.spawn(_launch, *args, **kwargs)
 
-def listen_to_ev(ev_classes):
+def listen_to_ev(ev_classes, inline=False):
+    """Mark a method as the handler of ev_classes. An inline handler is called
+    directly by the sender of the event and so must not block; other handlers run
+    from the app's event loop."""
     def set_ev_handler(handler):
         if not hasattr(handler, 'events_to_listen'):
             handler.events_to_listen = ev_classes
+            handler.inline = inline
         return handler
     return set_ev_handler
 
 def register_handlers(app):
-    for name, method in inspect.getmembers(app, inspect.ismethod):
-        if hasattr(method, 'events_to_listen'):
-            for ev_cls in method.events_to_listen:
-                app.register_handler(ev_cls, method)
+    for name, ev_classes in app._ev_handler_specs:
+        handler = getattr(app, name)
+        for ev_cls in ev_classes:
+            app.register_handler(ev_cls, handler)
 
 class AppBase(object):
     """Base class for applications. All applications on sdRCP must be subclass of AppBase
     """
+    __slots__ = ('name', 'threads', 'handlers', 'inline_handlers', 'observers',
+                 '_observer_index', '_direct_handlers', 'events', 'main_thread', 'running')
+
+    # (method name, event classes) pairs collected from @listen_to_ev at class creation
+    _ev_handler_specs = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super(AppBase, cls).__init_subclass__(**kwargs)
+        specs = dict(cls._ev_handler_specs)
+        for name, attr in cls.__dict__.items():
+            if hasattr(attr, 'events_to_listen'):
+                specs[name] = attr.events_to_listen
+        cls._ev_handler_specs = tuple(specs.items())
 
     def __init__(self):
         self.name = self.__class__.__name__
         self.threads = []
         self.handlers = {}
+        self.inline_handlers = {}
         self.observers = {}
+        self._observer_index = {}
+        self._direct_handlers = {}
         self.events = eventlet.Queue(512)
         self.main_thread = None
         self.running = True
 
     def register_handler(self, ev_cls, handler):
-        self.handlers.setdefault(ev_cls, set())
-        self.handlers[ev_cls].add(handler)
+        if getattr(handler, 'inline', False):
+            handlers = self.inline_handlers
+        else:
+            handlers = self.handlers
+        registered = handlers.get(ev_cls, _EMPTY_HANDLERS)
+        if handler not in registered:
+            handlers[ev_cls] = registered + (handler,)
 
     def register_observers(self, apps):
         for app in apps:
             if app.name == self.name:
                 continue
-            for ev_cls in app.handlers.keys():
+            for ev_cls in set(app.handlers) | set(app.inline_handlers):
                 self.observers.setdefault(ev_cls, set())
                 self.observers[ev_cls].add(app)
                 logger.info('registered observer %s for event %s' % (app.name, ev_cls.__name__))
 
+    def finalize_observers(self):
+        """Flatten the observers of each event class into the inline handlers to call
+        directly and the apps whose queue the event is put on. Called once all apps
+        have registered as observers."""
+        direct_handlers = {}
+        observer_index = {}
+        for ev_cls, observers in self.observers.items():
+            for app in observers:
+                if ev_cls in app.inline_handlers:
+                    direct_handlers[ev_cls] = (
+                            direct_handlers.get(ev_cls, _EMPTY_HANDLERS) + app.inline_handlers[ev_cls])
+                if ev_cls in app.handlers:
+                    observer_index[ev_cls] = observer_index.get(ev_cls, ()) + (app,)
+        self._direct_handlers = direct_handlers
+        self._observer_index = observer_index
+
     def _get_handlers(self, event):
-        name = event.__class__
-        if name in self.handlers:
-            return self.handlers[name]
-        return []
+        return self.handlers.get(type(event), _EMPTY_HANDLERS)
 
     def _event_loop(self):
         while self.running:
-            try:
-                event = self.events.get()
-                handlers = self._get_handlers(event)
-                for handler in handlers:
+            event = self.events.get()
+            for handler in self._get_handlers(event):
+                try:
                     handler(event)
-            except Exception as e:
-                raise Exception(e)
-
-    def _get_observers(self, ev):
-        if ev.__class__ in self.observers:
-            return self.observers[ev.__class__]
-        return []
-
-    def _receive_event(self, ev):
-        self.events.put_nowait(ev)
+                except Exception:
+                    # a failing handler must not stop the app from processing events
+                    logger.exception('%s: handler %s failed for %r',
+                                     self.name, handler.__name__, event)
 
     def send_event_to_observers(self, ev):
-        for observer in self._get_observers(ev):
-            observer._receive_event(ev)
+        ev_cls = type(ev)
+        for handler in self._direct_handlers.get(ev_cls, _EMPTY_HANDLERS):
+            try:
+                handler(ev)
+            except Exception:
+                # inline handlers run in the sender's stack; their failure must not
+                # stop the sender nor the delivery to the other observers
+                logger.exception('%s: inline handler %s failed for %r',
+                                 self.name, handler.__name__, ev)
+        for observer in self._observer_index.get(ev_cls, ()):
+            observer.events.put_nowait(ev)
 
     def _main_loop(self):
         return
@@ -146,6 +194,8 @@ class AppManager(object):
             register_handlers(app)
         for name, app in self.applications.items():
             app.register_observers(self.applications.values())
+        for app in self.applications.values():
+            app.finalize_observers()
 
     def instantiate_apps(self):
         threads = []
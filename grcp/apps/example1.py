@@ -1,21 +1,25 @@
+import logging
 
 from grcp.core.topology import EventRouterUp, EventRouterDown, \
                                EventRouteAdd, EventRouteDel
 from grcp.core import model
 from grcp.app_manager import AppBase, get_topo_manager, listen_to_ev
 
+logger = logging.getLogger('grcp.example1')
+
 
 class BgpExample1(AppBase):
+    __slots__ = ('routers', 'topo')
 
     def __init__(self):
         super(BgpExample1, self).__init__()
         self.routers = {}
         self.topo = get_topo_manager()
 
-    @listen_to_ev([EventRouterUp])
+    @listen_to_ev([EventRouterUp], inline=True)
     def register_router(self, ev):
         router = ev.msg
-        print('register router: %s' % router.routerid)
+        logger.debug('register router: %s', router.routerid)
         self.routers[router.routerid] = router
 
     @listen_to_ev([EventRouteAdd])
@@ -24,8 +28,10 @@ class BgpExample1(AppBase):
         prefix = route.prefix
         for routerid in self.routers.keys():
             qry = model.Path.query(routerid=routerid, prefix=prefix)
-            qry = qry.order(model.Path.route_pref)
+            # BGP tie-breakers: highest local_pref, shortest as_path, lowest med
+            qry = qry.order(-model.Path.route_pref, model.Path.route_aspath,
+                            model.Path.route_med)
             paths = list(qry.fetch(limit=1))
-            print(paths)
+            logger.debug('best path for %s to %s: %s', routerid, prefix, paths)
             if paths:
                 self.topo.create_mapping(routerid=routerid, prefix=prefix, path_info=paths[0])
@@ -5,6 +5,9 @@ opts = [
         cfg.StrOpt('bind_host', default='0.0.0.0', help='IP address to listen on.'),
         cfg.Opt('bind_port', type=types.Integer(1024, 65535), default=9999,
             help='Port number to listen on.'),
+        cfg.StrOpt('framing', default='line', choices=['line', 'int32'],
+            help='How messages to and from routers are delimited: by a newline or '
+                 'by a 4-byte length prefix.'),
         cfg.ListOpt('app_list', default=[], help='app module names to run.'),
         cfg.MultiStrOpt('app', default=[], positional=True, help='app module names to run.'),
         ]
@@ -1,43 +1,98 @@
 import eventlet
-eventlet.monkey_patch()
 
+import sys
+import collections
+import operator
 import traceback
 import ipaddress
 import logging
 import json
 
+try:
+    import msgspec
+    # messages are always JSON objects; a decoder typed as dict rejects anything
+    # else while parsing
+    _loads = msgspec.json.Decoder(dict).decode
+except ImportError:
+    try:
+        import orjson
+        _loads = orjson.loads
+    except ImportError:
+        _loads = json.loads
+
 from . import messenger
 from grcp.cfg import CONF
+from grcp.app_manager import spawn
 
 logger = logging.getLogger('grcp.controller')
 
+_update_fields = operator.itemgetter('peer_ip', 'prefix', 'next_hop')
+
 
 class RouterController(object):
     """This class handles communication between the controller and the fBGP module.
     """
+    # most messages handled in one go by the receive loop
+    MAX_BATCH = 256
+    # most routes (and nexthops) remembered to filter out repeated updates
+    CACHE_SIZE = 100000
+
+    __slots__ = ('handler', 'messenger', 'router_to_connection', 'connection_to_routers',
+                 'incoming', 'incoming_ready', 'outgoing', 'outgoing_ready', '_dispatch',
+                 'route_cache', 'nexthop_cache')
     def __init__(self, handler):
         self.handler = handler
-        self.messenger = messenger.MessengerServer(self.receive_msg, self.handle_disconnect)
+        self.messenger = messenger.MessengerServer(
+                self.receive_msg, self.handle_disconnect, CONF.framing)
         self.router_to_connection = {}
-        self.incomming_queue = eventlet.Queue(512)
-        self.outgoing_queue = eventlet.Queue(512)
+        self.connection_to_routers = {}
+        # (conn_id, msg) pairs; each is drained by a single green thread that
+        # sleeps on the matching event while its deque is empty
+        self.incoming = collections.deque()
+        self.incoming_ready = eventlet.Event()
+        self.outgoing = collections.deque()
+        self.outgoing_ready = eventlet.Event()
+        # (prefix, nexthop) -> attributes and (routerid, nexthop) -> attributes of
+        # the last update written to the database, least recently seen first. BGP
+        # repeats updates a lot (e.g. after a session reset) and those need no write
+        self.route_cache = collections.OrderedDict()
+        self.nexthop_cache = collections.OrderedDict()
+        # bind the handlers once so that subclass overrides are honoured and each
+        # message costs a single lookup
+        self._dispatch = {
+                msg_type: getattr(self, func.__name__)
+                for msg_type, func in self._DISPATCH.items()}
 
-    def _recv_loop(self, queue):
+    @staticmethod
+    def _drain_loop(pending, ready, process):
+        # everything queued since the last wake-up is handled in one go
         while True:
-            (clientid, msg) = queue.get()
-            self._process_msg(clientid, msg)
-            queue.task_done()
+            ready.wait()
+            ready.reset()
+            while pending:
+                process(*pending.popleft())
 
-    def _send_loop(self, queue):
+    @staticmethod
+    def _enqueue(pending, ready, item):
+        pending.append(item)
+        if not ready.ready():
+            ready.send()
+
+    def _recv_loop(self):
+        incoming = self.incoming
         while True:
-            (conn_id, msg) = queue.get()
-            self.messenger.send(conn_id, msg)
-            queue.task_done()
+            self.incoming_ready.wait()
+            self.incoming_ready.reset()
+            while incoming:
+                batch = []
+                while incoming and len(batch) < self.MAX_BATCH:
+                    batch.append(incoming.popleft())
+                self._process_msgs(batch)
 
     def __call__(self):
         logger.info('The server is listening on %s:%s' % (CONF.bind_host, CONF.bind_port))
-        eventlet.spawn(self._send_loop, self.outgoing_queue)
-        eventlet.spawn(self._recv_loop, self.incomming_queue)
+        spawn(self._drain_loop, self.outgoing, self.outgoing_ready, self.messenger.send)
+        spawn(self._recv_loop)
         self.messenger.run_forever(CONF.bind_port)
 
     def _process_router_msg(self, conn_id, msg):
@@ -54,12 +109,21 @@ class RouterController(object):
                 self.handler.router_up(routerid)
             else:
                 self.handler.router_register(routerid, **attr)
+            self._unbind_router(routerid)
             self.router_to_connection[routerid] = conn_id
+            self.connection_to_routers.setdefault(conn_id, set()).add(routerid)
         elif msg_type == 'router_down':
+            self._unbind_router(routerid)
             self.router_to_connection[routerid] = None
             self.handler.router_down(routerid)
 
-    def _process_peer_msg(self, msg):
+    def _unbind_router(self, routerid):
+        """Remove routerid from the routers of the connection it was last seen on."""
+        routers = self.connection_to_routers.get(self.router_to_connection.get(routerid))
+        if routers:
+            routers.discard(routerid)
+
+    def _process_peer_msg(self, conn_id, msg):
         msg_type = msg.get('msg_type')
         peer_ip = msg.get('peer_ip')
         local_ip = msg.get('local_ip')
@@ -74,22 +138,65 @@ class RouterController(object):
         else:
             self.handler.peer_down(peer_ip, local_ip)
 
-    def _process_update_msg(self, msg):
-        peer_ip = msg.get('peer_ip')
-        prefix = msg.get('prefix')
-        nexthop = msg.get('next_hop')
+    @staticmethod
+    def _route_up_args(msg):
+        """Return (nexthop, prefix, attrs) of a route_up msg or None if malformed."""
+        try:
+            peer_ip, prefix, nexthop = _update_fields(msg)
+        except KeyError:
+            return None
         if not (nexthop and prefix and peer_ip):
+            return None
+        # the route is cached by (prefix, nexthop) and compared on its as_path
+        if not (isinstance(nexthop, str) and isinstance(prefix, str)):
+            return None
+        as_path = msg.get('as_path', [])
+        if not isinstance(as_path, list):
+            return None
+        attrs = {
+                'local_pref': msg.get('local_pref', 100),
+                'as_path': as_path,
+                'med': msg.get('med', 100)}
+        return nexthop, prefix, attrs
+
+    @staticmethod
+    def _is_cached(cache, key, value):
+        """Return True if key was last written with value."""
+        if cache.get(key) == value:
+            cache.move_to_end(key)
+            return True
+        return False
+
+    def _remember(self, cache, key, value):
+        """Remember that key was written with value; only call once it was."""
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.CACHE_SIZE:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def _route_value(attrs):
+        return (attrs['local_pref'], attrs['med'], tuple(attrs['as_path']))
+
+    def _is_new_route(self, route):
+        nexthop, prefix, attrs = route
+        return not self._is_cached(self.route_cache, (prefix, nexthop), self._route_value(attrs))
+
+    def _process_update_msg(self, conn_id, msg):
+        if msg['msg_type'] == 'route_up':
+            route = self._route_up_args(msg)
+            if route and self._is_new_route(route):
+                self._flush_routes([route])
             return
-        if msg.get('msg_type') == 'route_up':
-            self.handler.route_up(
-                    nexthop, prefix,
-                    local_pref=msg.get('local_pref', 100),
-                    as_path=msg.get('as_path', []),
-                    med=msg.get('med', 100))
-        else:
+        try:
+            peer_ip, prefix, nexthop = _update_fields(msg)
+        except KeyError:
+            return
+        if nexthop and prefix and peer_ip:
+            self.route_cache.pop((prefix, nexthop), None)
             self.handler.route_down(peer_ip, nexthop, prefix)
 
-    def _process_nexthop_msg(self, msg):
+    def _process_nexthop_msg(self, conn_id, msg):
         routerid = msg.get('routerid')
         nexthop = msg.get('nexthop')
         if not (routerid and nexthop):
@@ -100,13 +207,18 @@ class RouterController(object):
             port_name = msg.get('port_name')
             port_no = msg.get('port_no')
             vlan_vid = msg.get('vlan_vid')
+            value = (pathid, dp_id, port_name, port_no, vlan_vid)
+            if self._is_cached(self.nexthop_cache, (routerid, nexthop), value):
+                return
             self.handler.nexthop_up(routerid=routerid, nexthop=nexthop,
                                     pathid=pathid, dp_id=dp_id, port_no=port_no,
                                     port_name=port_name, vlan_vid=vlan_vid)
+            self._remember(self.nexthop_cache, (routerid, nexthop), value)
         else:
+            self.nexthop_cache.pop((routerid, nexthop), None)
             self.handler.nexthop_down(routerid, nexthop)
 
-    def _process_link_state_msg(self, msg):
+    def _process_link_state_msg(self, conn_id, msg):
         router1 = msg.get('src')
         router2 = msg.get('dst')
         if not (router1 and router2):
@@ -120,47 +232,104 @@ class RouterController(object):
         else:
             self.handler.intra_link_down(router1, router2)
 
-    def _process_msg(self, conn_id, msg):
-        logger.debug('processing msg %s from %s' % (msg, conn_id))
+    # msg_type -> handler; every handler takes (conn_id, msg). Bound per instance
+    # in __init__
+    _DISPATCH = {
+            'route_up': _process_update_msg,
+            'route_down': _process_update_msg,
+            'router_up': _process_router_msg,
+            'router_down': _process_router_msg,
+            'peer_up': _process_peer_msg,
+            'peer_down': _process_peer_msg,
+            'link_up': _process_link_state_msg,
+            'link_down': _process_link_state_msg,
+            'nexthop_up': _process_nexthop_msg,
+            'nexthop_down': _process_nexthop_msg,
+            }
+
+    @staticmethod
+    def _decode_msg(msg):
+        if isinstance(msg, dict):
+            # made by the controller itself
+            return msg
+        msg = _loads(msg)
+        msg_type = msg.get('msg_type')
+        if isinstance(msg_type, str):
+            # the handlers compare msg_type against literals again; once interned
+            # those comparisons and the dispatch lookup succeed on identity
+            msg['msg_type'] = sys.intern(msg_type)
+        return msg
+
+    def _process_msgs(self, batch):
+        """Process (conn_id, msg) pairs in order. Consecutive route_up messages are
+        handed to the handler as one batch so they are written together."""
+        # (prefix, nexthop) -> route; a later update of a route replaces the
+        # pending one
+        routes = {}
+        for conn_id, msg in batch:
+            logger.debug('processing msg %s from %s', msg, conn_id)
+            try:
+                msg = self._decode_msg(msg)
+            except Exception as e:
+                logger.error('error encountered when decoding msg %s: %s' % (msg, e))
+                continue
+            # a bad message must not stop the handling of the others
+            try:
+                msg_type = msg.get('msg_type')
+                if msg_type == 'route_up':
+                    route = self._route_up_args(msg)
+                    if route:
+                        key = (route[1], route[0])
+                        if key in routes or self._is_new_route(route):
+                            routes[key] = route
+                    continue
+                handler = self._dispatch.get(msg_type)
+            except Exception as e:
+                logger.error('error encountered when handling msg %s: %s' % (msg, e))
+                traceback.print_exc()
+                continue
+            self._flush_routes(list(routes.values()))
+            routes = {}
+            if handler:
+                try:
+                    handler(conn_id, msg)
+                except Exception as e:
+                    logger.error('error encountered when handling msg %s: %s' % (msg, e))
+                    traceback.print_exc()
+        self._flush_routes(list(routes.values()))
+
+    def _flush_routes(self, routes):
+        """Write the (nexthop, prefix, attrs) routes. Only those the handler reports
+        as written are cached, so the next updates of the others are let through."""
+        if not routes:
+            return
         try:
-            msg = json.loads(msg)
-            msg_type = msg.get('msg_type')
-            if msg_type in ['route_up', 'route_down']:
-                self._process_update_msg(msg)
-            elif msg_type in ['router_up', 'router_down']:
-                self._process_router_msg(conn_id, msg)
-            elif msg_type in ['peer_up', 'peer_down']:
-                self._process_peer_msg(msg)
-            elif msg_type in ['link_up', 'link_down']:
-                self._process_link_state_msg(msg)
-            elif msg_type in ['nexthop_up', 'nexthop_down']:
-                self._process_nexthop_msg(msg)
+            if len(routes) == 1:
+                nexthop, prefix, attrs = routes[0]
+                written = routes if self.handler.route_up(nexthop, prefix, **attrs) else []
+            else:
+                written = self.handler.routes_up(routes)
         except Exception as e:
-            logger.error('error encountered when handling msg %s: %s' % (msg, e))
+            logger.error('error encountered when adding %d routes: %s' % (len(routes), e))
             traceback.print_exc()
+            return
+        for nexthop, prefix, attrs in written:
+            self._remember(self.route_cache, (prefix, nexthop), self._route_value(attrs))
 
     def receive_msg(self, conn_id, msg):
-        #TODO: using queue doesn't work. don't understand why. it hanges up somewhere
-        #self.incomming_queue.put((conn_id, msg))
-        #eventlet.sleep(0) # this is really important, without it spawn won't work
-        self._process_msg(conn_id, msg)
+        # messages are always queued: handling one inline would keep the reactor
+        # from reading the next ones, so no batch could ever build up
+        self._enqueue(self.incoming, self.incoming_ready, (conn_id, msg))
 
     def handle_disconnect(self, conn_id):
-        # mark routers as down
-        for router_id in list(self.router_to_connection.keys()):
-            if self.router_to_connection[router_id] == conn_id:
-                self.router_to_connection.pop(router_id)
-                self.incomming_queue.put_nowait((
-                    conn_id,
-                    '{"msg_type": "router_down", "routerid": "%s"}' % router_id))
-
-    def _get_connection_by_router_id(self, router_id):
-        # TODO: race condition may occur
-        conn_id = self.router_to_connection.get(router_id, None)
-        return conn_id
+        # mark routers as down, but only after the messages still queued from this
+        # connection; the messages are queued as dicts so they skip decoding
+        for router_id in self.connection_to_routers.pop(conn_id, ()):
+            self._enqueue(self.incoming, self.incoming_ready,
+                          (conn_id, {'msg_type': 'router_down', 'routerid': router_id}))
 
     def send_msg(self, router_id, msg):
         """send a message to a specific router identified by router_id."""
-        conn_id = self._get_connection_by_router_id(router_id)
+        conn_id = self.router_to_connection.get(router_id)
         if conn_id:
-            self.outgoing_queue.put_nowait((conn_id, msg))
+            self._enqueue(self.outgoing, self.outgoing_ready, (conn_id, msg))
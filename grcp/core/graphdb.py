@@ -14,12 +14,23 @@ This module is used by the model module which provides an abstraction to BGP rou
 import time
 import json
 import logging
+import functools
+import operator
+import contextlib
+import collections
+import threading
 
 logger = logging.getLogger('grcp.graphdb')
 
 DEFAULT_DB_URI = 'bolt://localhost:7687'
 DEFAULT_DB_USER = 'neo4j'
 DEFAULT_DB_PASS = 'neo4j'
+# seconds to keep retrying to connect to the database at start-up
+CONNECT_TIMEOUT = 60
+# times a query is retried after the connection to the database was lost
+QUERY_RETRIES = 3
+# most results kept by exec_query_cached
+READ_CACHE_SIZE = 4096
 
 class GraphDB():
 
@@ -28,136 +39,416 @@ class GraphDB():
 
 class Neo4J(GraphDB):
 
-    from neo4j.v1 import GraphDatabase
+    from neo4j.v1 import GraphDatabase, SessionExpired, READ_ACCESS
     from neo4j.v1.types.graph import Node, Relationship
-    from neo4j.exceptions import ConstraintError
+    from neo4j.exceptions import ConstraintError, ClientError, ServiceUnavailable, TransientError
 
     def __init__(self, db_uri=None, db_user=None, db_pass=None):
         uri = db_uri or DEFAULT_DB_URI
         username = db_user or DEFAULT_DB_USER
         password = db_pass or DEFAULT_DB_PASS
         self.driver = None
-        for _ in range(60):
+        # creating the driver opens (and checks) a first connection, so it is
+        # ready as soon as this succeeds
+        deadline = time.time() + CONNECT_TIMEOUT
+        delay = 0.1
+        while True:
             try:
                 self.driver = self.GraphDatabase.driver(uri, auth=(username, password))
-            except:
-                time.sleep(1)
-        if not self.driver:
-            raise Exception('Failed to connect to Neo4j server: %s' % uri)
+                break
+            except self.ServiceUnavailable as e:
+                # anything else (e.g. wrong credentials) will not go away by waiting
+                if time.time() + delay > deadline:
+                    logger.error('Failed to connect to Neo4j server %s: %s' % (uri, e))
+                    raise Exception('Failed to connect to Neo4j server: %s' % uri)
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+        # a single session is kept open and shared by all queries; the lock
+        # serializes its use between green threads. It is held for the whole of a
+        # transaction() block, so it has to be reentrant
+        self._session = None
+        # session in read mode for exec_read; with a routing driver (bolt+routing://)
+        # its queries can be served by read replicas
+        self._read_session = None
+        # bookmark of the write session the read session was opened at
+        self._read_bookmark = None
+        self._session_lock = threading.RLock()
+        self._tx = None
+        # (label, property) pairs known to be indexed, loaded on first use
+        self._indexed = None
+        # the pairs of those that are unique constraints
+        self._unique = None
+        # (query, params) -> (expiry time, records) of exec_query_cached, emptied
+        # by every write
+        self._read_cache = collections.OrderedDict()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed():
+            self._session = self.driver.session()
+        return self._session
+
+    def _last_bookmark(self):
+        """Bookmark of the last write, which a read must wait for to see it."""
+        return self._session.last_bookmark() if self._session is not None else None
+
+    def _get_read_session(self):
+        # a read replica may lag behind; after a write the read session is opened
+        # again at its bookmark so that its reads see the write
+        bookmark = self._last_bookmark()
+        if self._read_session is None or self._read_session.closed() \
+                or bookmark != self._read_bookmark:
+            self._close_read_session()
+            self._read_session = self.driver.session(
+                    access_mode=self.READ_ACCESS, bookmark=bookmark)
+            self._read_bookmark = bookmark
+        return self._read_session
+
+    def _close_session(self):
+        if self._session is not None:
+            try:
+                self._session.close()
+            except Exception:
+                pass
+            self._session = None
+
+    def _close_read_session(self):
+        if self._read_session is not None:
+            try:
+                self._read_session.close()
+            except Exception:
+                pass
+            self._read_session = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run all queries of the block, including those of the helper methods, in a
+        single transaction that is committed at the end of the block (or rolled back
+        if it raises). Other green threads wait until then. Nested blocks join the
+        outer transaction."""
+        with self._session_lock:
+            if self._tx is not None:
+                yield self._tx
+                return
+            tx = self._get_session().begin_transaction()
+            self._tx = tx
+            try:
+                yield tx
+                tx.commit()
+            except Exception:
+                try:
+                    if not tx.closed():
+                        tx.rollback()
+                except Exception:
+                    self._close_session()
+                raise
+            finally:
+                self._tx = None
+                # reads made inside the block may have seen writes that were then
+                # rolled back
+                self._read_cache.clear()
+
+    def close(self):
+        """Close the shared session and the driver."""
+        with self._session_lock:
+            self._close_session()
+            self._close_read_session()
+        self.driver.close()
 
     @staticmethod
-    def _dict_to_match_str(d):
-        """convert a dict into cypher-compliant string.
-        Ex: {"label": "A", "cost": 2, "name": "R1"} -> '{:A {cost: 2, name:"R"}'
+    def _dict_to_match_str(d, prefix='match'):
+        """convert a dict into cypher-compliant string whose values are query
+        parameters named after prefix. Return the string and the parameters.
+        Ex: ({"label": "A", "cost": 2, "name": "R1"}, 'src') ->
+            (':A { cost: $src_cost, name: $src_name }', {'src_cost': 2, 'src_name': 'R1'})
         """
         if not d:
-            return ''
-        kind = d.pop('label', None)
-        match_str = []
-        for k, v in d.items():
-            if isinstance(v, str):
-                match_str.append('%s: "%s"' % (k, v))
-            else:
-                match_str.append('%s: %s' % (k, v))
-        match_str = ', '.join(match_str)
+            return '', {}
+        match_str, names, values = Neo4J._match_template(d.get('label'), tuple(d), prefix)
+        return match_str, dict(zip(names, values(d)))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _match_template(kind, keys, prefix):
+        """Return the match string, the parameter names and a function that picks the
+        parameter values out of a dict with keys. There are only a few shapes of match
+        so they are built once."""
+        keys = tuple([k for k in keys if k != 'label'])
+        names = tuple(['%s_%s' % (prefix, k) for k in keys])
+        match_str = ', '.join(['%s: $%s' % (k, name) for k, name in zip(keys, names)])
         match_str = '{ %s }' % match_str
         if kind:
             match_str = ':%s %s' % (kind, match_str)
-        return match_str
+        if len(keys) > 1:
+            values = operator.itemgetter(*keys)
+        elif keys:
+            # itemgetter of a single key does not return a tuple
+            key = keys[0]
+            values = lambda d: (d[key],)
+        else:
+            values = lambda d: ()
+        return match_str, names, values
 
     @staticmethod
-    def _dict_to_set_str(name, d):
-        """Turn a dict into Cypher SET command.
-        Ex. _dict_to_set_str('node', {'delay': 1.0, 'state': 'up'}) return
-            'node.delay=1.0, node.state="down"'
-        """
-        if not d:
-            return ''
-        set_str = []
-        for key, value in d.items():
-            if type(value) == str:
-                set_str.append('%s.%s="%s"' % (name, key, value))
-            else:
-                set_str.append('%s.%s=%s' % (name, key, value))
-        set_str = ', '.join(set_str)
-        if set_str:
-            set_str = 'SET ' + set_str
-        return set_str
+    def _one(records, key=None):
+        """Return the first record (or its field key), None if there is none."""
+        if not records:
+            return None
+        return records[0][key] if key else records[0]
 
     def exec_query(self, query, **params):
-        """Run a Cypher query."""
+        """Run a Cypher query and return the list of records. The records are read
+        while the session is held, so the list can be used after other queries ran.
+        The query may change the graph, so the results of exec_query_cached are
+        dropped."""
+        if not query:
+            return []
+        logger.debug('cypher: %s', query)
+        delay = 0.1
+        # cleared once the query is done, under the lock that exec_query_cached
+        # holds to read and fill, so no record read before a write is kept
+        with self._session_lock:
+            try:
+                for attempt in range(QUERY_RETRIES + 1):
+                    try:
+                        return list((self._tx or self._get_session()).run(query, params))
+                    except self.ConstraintError as e:
+                        # the server has failed an open transaction, which has to
+                        # be rolled back by its owner
+                        if self._tx is not None:
+                            raise
+                        logger.error('Error when executing %s: %s' % (query, e))
+                        return []
+                    except (self.ServiceUnavailable, self.SessionExpired, self.TransientError) as e:
+                        # the query is run again on a new session, unless it is part of
+                        # a transaction which has to be retried as a whole
+                        if self._tx is not None:
+                            raise
+                        self._close_session()
+                        if attempt == QUERY_RETRIES:
+                            raise
+                        logger.warning('Retrying %s after: %s' % (query, e))
+                        time.sleep(delay)
+                        delay *= 2
+                    except Exception:
+                        # the session may be unusable (e.g. broken connection); open a
+                        # new one for the next query. An open transaction cleans up on
+                        # its own
+                        if self._tx is None:
+                            self._close_session()
+                        raise
+            finally:
+                self._read_cache.clear()
+
+    def exec_read(self, query, **params):
+        """Run a read-only Cypher query and return the list of records. Outside of a
+        transaction() block it runs in a read transaction, which the driver retries
+        on transient errors and a routing driver may send to a read replica."""
         if not query:
             return []
+        with self._session_lock:
+            if self._tx is not None:
+                # reads inside a transaction have to see its writes
+                return self.exec_query(query, **params)
+            logger.debug('cypher: %s', query)
+            try:
+                return self._get_read_session().read_transaction(
+                        lambda tx: list(tx.run(query, params)))
+            except Exception:
+                self._close_read_session()
+                raise
+
+    def pipeline(self, statements):
+        """Run many (query, params) statements in one transaction. All of them are
+        sent before any result is read, so they share the round-trips to the server
+        instead of paying one each as with exec_query.
+
+        :rtype: list of the lists of records, one per statement
+        """
+        if not statements:
+            return []
+        with self.transaction() as tx:
+            for query, _ in statements:
+                logger.debug('cypher: %s', query)
+            results = [tx.run(query, params) for query, params in statements]
+            return [list(result) for result in results]
+
+    def exec_query_stream(self, query, **params):
+        """Run a read-only Cypher query and yield its records as they are received
+        rather than reading them all first. It runs on a session of its own, so the
+        shared one is free for other queries while the records are consumed. Inside
+        a transaction() block the records are read by exec_query."""
+        if not query:
+            return
+        with self._session_lock:
+            records = self.exec_query(query, **params) if self._tx is not None else None
+            bookmark = self._last_bookmark()
+        if records is not None:
+            yield from records
+            return
+        logger.debug('cypher: %s', query)
+        with self.driver.session(access_mode=self.READ_ACCESS, bookmark=bookmark) as session:
+            for record in session.run(query, params):
+                yield record
+
+    def _is_indexed(self, kind, prop, unique=False):
+        """Return True if nodes of kind are indexed on prop; with unique, only if
+        by a unique constraint."""
+        if self._indexed is None:
+            self._indexed = set()
+            self._unique = set()
+            for record in self.exec_read('CALL db.indexes()'):
+                # the columns naming the labels and telling unique indexes differ
+                # between Neo4j versions
+                labels = record.get('tokenNames') or record.get('labelsOrTypes') \
+                        or [record.get('label')]
+                props = record.get('properties') or []
+                if len(labels) == 1 and len(props) == 1:
+                    self._indexed.add((labels[0], props[0]))
+                    if record.get('type') == 'node_unique_property' \
+                            or record.get('uniqueness') == 'UNIQUE':
+                        self._unique.add((labels[0], props[0]))
+        return (kind, prop) in (self._unique if unique else self._indexed)
+
+    def _set_indexed(self, pairs, unique=False):
+        self._indexed.update(pairs)
+        if unique:
+            self._unique.update(pairs)
+
+    def _exec_write(self, query, **params):
+        """exec_query for queries that change the graph."""
+        return self.exec_query(query, **params)
+
+    def exec_query_cached(self, query, ttl=1.0, **params):
+        """Like exec_read. The result is reused for ttl
+        seconds unless the graph is changed through this instance in between."""
         try:
-            with self.driver.session() as session:
-                return session.run(query, params)
-        except self.ConstraintError:
-            logger.error('Error when executing %s: %s' % (query, e))
-            pass
-        except Exception as e:
-            raise e
-        return []
+            key = (query, tuple(sorted(params.items())))
+            hash(key)
+        except TypeError:
+            # unhashable parameter values (e.g. lists)
+            return self.exec_read(query, **params)
+        with self._session_lock:
+            if self._tx is not None:
+                # what a transaction reads may yet be rolled back
+                return self.exec_read(query, **params)
+            cached = self._read_cache.get(key)
+            now = time.time()
+            if cached is not None and cached[0] > now:
+                self._read_cache.move_to_end(key)
+                return list(cached[1])
+            records = self.exec_read(query, **params)
+            self._read_cache[key] = (now + ttl, records)
+            self._read_cache.move_to_end(key)
+            if len(self._read_cache) > READ_CACHE_SIZE:
+                self._read_cache.popitem(last=False)
+            return list(records)
 
     def create_constraint(self, kind, prop):
         """Make sure that each node with kind has unique property prop."""
+        if self._is_indexed(kind, prop, unique=True):
+            return
         qry = 'CREATE CONSTRAINT ON (n:%s) ASSERT n.%s IS UNIQUE' % (kind, prop)
-        self.exec_query(qry)
+        if self._exec_schema(qry):
+            self._set_indexed([(kind, prop)], unique=True)
+
+    def create_constraints(self, pairs):
+        """Batch version of create_constraint for many (kind, prop). The missing
+        constraints are created in one transaction; if that fails, each is tried on
+        its own."""
+        missing = []
+        for kind, prop in pairs:
+            if not self._is_indexed(kind, prop, unique=True) and (kind, prop) not in missing:
+                missing.append((kind, prop))
+        if not missing:
+            return
+        statements = [('CREATE CONSTRAINT ON (n:%s) ASSERT n.%s IS UNIQUE' % (kind, prop), {})
+                      for kind, prop in missing]
+        try:
+            self.pipeline(statements)
+        except self.ClientError as e:
+            logger.warning('Failed to create constraints together: %s', e)
+            for kind, prop in missing:
+                self.create_constraint(kind, prop)
+            return
+        self._set_indexed(missing, unique=True)
 
     def create_index(self, kind, prop):
+        if self._is_indexed(kind, prop):
+            return
         qry = 'CREATE INDEX ON :%s(%s)' % (kind, prop)
-        self.exec_query(qry)
+        if self._exec_schema(qry):
+            self._set_indexed([(kind, prop)])
+
+    def ensure_indexes(self, kinds, props, unique=False):
+        """Make sure nodes of every kind are indexed on every prop (with a unique
+        constraint if unique). Existing indexes and constraints are left alone."""
+        for kind in kinds:
+            for prop in props:
+                if unique:
+                    self.create_constraint(kind, prop)
+                else:
+                    self.create_index(kind, prop)
+
+    def _exec_schema(self, qry):
+        # schema left over from an earlier run (e.g. an index where a constraint is
+        # now wanted) must not stop the start-up
+        try:
+            self.exec_query(qry)
+            return True
+        except self.ClientError as e:
+            logger.warning('Failed to execute %s: %s' % (qry, e))
+            return False
 
     def clear_db(self):
         """Clear everything from the database."""
-        self.delete_node()
+        self.delete_node(fetch=False)
 
-    def delete_node(self, kind=None, match={}):
+    def delete_node(self, kind=None, match=None, fetch=True):
         """Delete a node from the database. Leave out labels and filters to delete everything
         labels (list) to define kinds of the node
         filters (dict) a set of property names and values to match on.
+        With fetch=False only the number of deleted nodes is returned.
         Ex:
         delete_node('Border', {'name': 'R'}) to delete all Border nodes with name = R
         delete_node(filters={'name': 'R'}) to delete all nodes with name = R
         """
-        kind = ':' + kind if kind else ''
-        where_str = self._dict_to_match_str(match)
-        qry = 'MATCH (node {label} {filter_str}) DETACH DELETE node RETURN node'
-        records = list(self.exec_query(qry.format(label=kind, filter_str=where_str)))
-        return records
+        where_str, params = self._dict_to_match_str(match)
+        records = self._exec_write(self._delete_node_qry(kind, where_str, fetch), **params)
+        if fetch:
+            return records
+        return self._one(records, 'deleted')
 
-    def create_node(self, labels, match, properties={}):
+    def create_node(self, labels, match, properties=None):
         """Create a new node with labels as node kind and properties. If a 'uid' in
         the properties dict and a node with the same uid exist, it will be updated with
         the new properties.
         """
-        if isinstance(labels, list):
-            kind = ":".join(labels)
-        else:
-            kind = ':' % labels
-        match = self._dict_to_match_str(match)
-        qry = 'MERGE ( node:{kind} {match} ) '\
-              'ON CREATE SET node=$properties '\
-              'ON MATCH SET node=$properties '\
-              'RETURN node'
-        qry = qry.format(kind=kind, match=match)
-        records = list(self.exec_query(qry, properties=properties))
-        if records:
-            return records[0]['node']
-        return None
-
-    def update_node(self, match, kind, properties={}):
-        set_str = self._dict_to_set_str('node', properties)
-        match = self._dict_to_match_str(match)
+        return self._one(self.create_nodes(labels, [{'match': match, 'properties': properties or {}}]))
+
+    def update_node(self, match, kind, properties=None):
+        match, params = self._dict_to_match_str(match)
+        qry = self._update_node_qry(kind, match)
+        return self._one(self._exec_write(qry, properties=properties or {}, **params), 'node')
+
+    # The query templates below are built once per kind and match string; the
+    # values themselves are passed as parameters
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _delete_node_qry(kind, match, fetch):
+        qry = 'MATCH (node {label} {filter_str}) DETACH DELETE node RETURN %s' % (
+                'node' if fetch else 'count(*) AS deleted')
+        return qry.format(label=':' + kind if kind else '', filter_str=match)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _update_node_qry(kind, match):
         qry = 'MATCH ( node:{kind} {match} ) '\
-              '{set_str} '\
+              'SET node += $properties '\
               'RETURN node'
-        qry = qry.format(kind=kind, match=match, set_str=set_str)
-        records = list(self.exec_query(qry))
-        if records:
-            return records[0]['node']
-        return None
+        return qry.format(kind=kind, match=match)
 
-    def create_link(self, kind, src, dst, properties={}):
+    def create_link(self, kind, src, dst, properties=None):
         """create a link between a src Node and a dst Node. src node must exist.
         Argument create_dst can be used to turn on/off dst node condition.
 
@@ -165,45 +456,170 @@ class Neo4J(GraphDB):
         :param dst: match (dict) on dst node
         :rtype: a link record
         """
-        src_match = self._dict_to_match_str(src)
-        dst_match = self._dict_to_match_str(dst)
-        set_str = []
-        set_str = self._dict_to_set_str(kind, properties)
-        if set_str:
-            set_str = ' ON CREATE %s \n ON MATCH %s ' % (set_str, set_str)
-        qry = 'MATCH ( src {src_match} ), (dst {dst_match} ) '\
+        return self._one(self.create_links(
+                kind, [{'src': src, 'dst': dst, 'properties': properties or {}}]))
+
+    @staticmethod
+    def _row_match_str(name, d):
+        """Turn a dict into a match on the fields of an UNWIND row. The values are
+        not used, only the keys (and label).
+        Ex: _row_match_str('src', {'label': 'A', 'uid': 1}) -> ':A { uid: row.src.uid }'
+        """
+        return Neo4J._row_match_template(name, d.get('label'), tuple(d))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _row_match_template(name, kind, keys):
+        match_str = ', '.join(['%s: row.%s.%s' % (k, name, k) for k in keys if k != 'label'])
+        if match_str:
+            match_str = '{ %s }' % match_str
+        if kind:
+            match_str = ':%s %s' % (kind, match_str)
+        return match_str
+
+    def create_nodes(self, labels, rows):
+        """Create (or update) many nodes in a single query. Each row is a dict with
+        'match' and 'properties' as in create_node. All rows must match on the same
+        property names.
+
+        :rtype: list of nodes
+        """
+        if not rows:
+            return []
+        if isinstance(labels, (list, tuple)):
+            kind = ":".join(labels)
+        else:
+            kind = str(labels)
+        qry = self._create_nodes_qry(kind, self._row_match_str('match', rows[0]['match']))
+        return [record['node'] for record in self._exec_write(qry, rows=rows)]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _create_nodes_qry(kind, match):
+        qry = 'UNWIND $rows AS row '\
+              'MERGE ( node:{kind} {match} ) '\
+              'SET node=row.properties '\
+              'RETURN node'
+        return qry.format(kind=kind, match=match)
+
+    def create_links(self, kind, rows):
+        """Create (or update) many links of the same kind in a single query. Each row
+        is a dict with 'src', 'dst' and 'properties' as in create_link. All rows must
+        match src and dst nodes on the same labels and property names.
+
+        :rtype: list of link records
+        """
+        if not rows:
+            return []
+        qry = self._create_links_qry(kind,
+                                     self._row_match_str('src', rows[0]['src']),
+                                     self._row_match_str('dst', rows[0]['dst']))
+        return self._exec_write(qry, rows=rows)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _create_links_qry(kind, src_match, dst_match):
+        qry = 'UNWIND $rows AS row '\
+              'MATCH ( src {src_match} ), (dst {dst_match} ) '\
               'MERGE ( src )-[{name}:{kind}]->( dst ) '\
-              '{set_str} RETURN src.uid AS src, dst.uid AS dst, {name}'
-        qry = qry.format(src_match=src_match, dst_match=dst_match, name=kind, kind=kind, set_str=set_str)
-        records = list(self.exec_query(qry))
-        logger.debug('executed: %s' % qry)
-        if records:
-            return records[0]
-        return None
-
-    def update_link(self, kind, src, dst, properties={}):
-        set_str = self._dict_to_set_str(kind, properties)
-        src_match = self._dict_to_match_str(src)
-        dst_match = self._dict_to_match_str(dst)
+              'SET {name} += row.properties '\
+              'RETURN src.uid AS src, dst.uid AS dst, {name}'
+        return qry.format(src_match=src_match, dst_match=dst_match, name=kind, kind=kind)
+
+    def get_nodes_by_uids(self, uids, kind=None):
+        """Fetch many nodes by uid in a single query.
+
+        :rtype: dict of uid -> node; uids not found are left out
+        """
+        if not uids:
+            return {}
+        if kind:
+            records = self.exec_read(self._get_nodes_by_values_qry(kind, 'uid'), values=list(uids))
+        else:
+            records = self.exec_read('MATCH (node) WHERE node.uid IN $values RETURN node',
+                                     values=list(uids))
+        return {record['node']['uid']: record['node'] for record in records}
+
+    def get_nodes_by_values(self, kind, key, values):
+        """Fetch the nodes of kind whose property key is one of values in a single
+        query.
+
+        :rtype: list of node records
+        """
+        if not values:
+            return []
+        return self.exec_read(self._get_nodes_by_values_qry(kind, key), values=list(values))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _get_nodes_by_values_qry(kind, key):
+        return 'MATCH (node:{kind}) WHERE node.{key} IN $values RETURN node'.format(
+                kind=kind, key=key)
+
+    def get_links_by_pairs(self, kind, pairs, src_kind=None, dst_kind=None,
+                           src_key='uid', dst_key='uid'):
+        """Fetch the links of kind between many (src, dst) pairs in a single query.
+        The src and dst nodes are matched on their uid, or on src_key and dst_key.
+        Each pair is matched on its own, which avoids the cartesian product of
+        matching all srcs against all dsts.
+
+        :rtype: list of link records
+        """
+        if not pairs:
+            return []
+        qry = self._get_links_by_pairs_qry(kind, src_kind, dst_kind, src_key, dst_key)
+        pairs = [{'src': src, 'dst': dst} for src, dst in pairs]
+        return self.exec_read(qry, pairs=pairs)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _get_links_by_pairs_qry(kind, src_kind, dst_kind, src_key, dst_key):
+        src_kind = ':' + src_kind if src_kind else ''
+        dst_kind = ':' + dst_kind if dst_kind else ''
+        qry = 'UNWIND $pairs AS pair '\
+              'MATCH ( src{src_kind} {{ {src_key}: pair.src }} )-[{name}:{kind}]->'\
+              '( dst{dst_kind} {{ {dst_key}: pair.dst }} ) '\
+              'RETURN src.uid AS src, dst.uid AS dst, {name}'
+        return qry.format(name=kind, kind=kind, src_kind=src_kind, dst_kind=dst_kind,
+                          src_key=src_key, dst_key=dst_key)
+
+    def update_link(self, kind, src, dst, properties=None):
+        src_match, params = self._dict_to_match_str(src, 'src')
+        dst_match, dst_params = self._dict_to_match_str(dst, 'dst')
+        params.update(dst_params)
+        qry = self._update_link_qry(kind, src_match, dst_match)
+        return self._one(self._exec_write(qry, properties=properties or {}, **params))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _update_link_qry(kind, src_match, dst_match):
         qry = 'MATCH ( src {src_match} )-[{name}: {kind}]->( dst {dst_match} ) '\
-              '{set_str} RETURN src.uid AS src, dst.uid AS dst, {name}'
-        records = list(self.exec_query(
-            qry.format(name=kind, kind=kind, set_str=set_str, src_match=src_match, dst_match=dst_match)))
-        if records:
-            return records[0]
-        return None
-
-    def delete_link(self, kind, match={}, src={}, dst={}):
+              'SET {name} += $properties RETURN src.uid AS src, dst.uid AS dst, {name}'
+        return qry.format(name=kind, kind=kind, src_match=src_match, dst_match=dst_match)
+
+    def delete_link(self, kind, match=None, src=None, dst=None, fetch=True):
         """Delete a link between a src Node and a dst Node. src and dst are dict that
-        describe the Node (property name and value to filter nodes). label is the link type."""
-        match_str = self._dict_to_match_str(match)
-        src_match = self._dict_to_match_str(src)
-        dst_match = self._dict_to_match_str(dst)
+        describe the Node (property name and value to filter nodes). label is the link type.
+        With fetch=False only the number of deleted links is returned."""
+        match_str, params = self._dict_to_match_str(match)
+        src_match, src_params = self._dict_to_match_str(src, 'src')
+        dst_match, dst_params = self._dict_to_match_str(dst, 'dst')
+        params.update(src_params)
+        params.update(dst_params)
+        qry = self._delete_link_qry(kind, match_str, src_match, dst_match, fetch)
+        records = self._exec_write(qry, **params)
+        if fetch:
+            return records
+        return self._one(records, 'deleted')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _delete_link_qry(kind, match, src_match, dst_match, fetch):
         qry = 'MATCH (src {src_match} ) -[{name}:{kind} {match}]->(dst {dst_match}) '\
-              'DELETE {name} RETURN src.uid AS src, dst.uid AS dst, {name}'
-        qry = qry.format(
-                name=kind, kind=kind, match=match_str, src_match=src_match, dst_match=dst_match)
-        return self.exec_query(qry)
+              'DELETE {name} RETURN %s' % (
+                      'src.uid AS src, dst.uid AS dst, {name}' if fetch else 'count(*) AS deleted')
+        return qry.format(
+                name=kind, kind=kind, match=match, src_match=src_match, dst_match=dst_match)
 
 
 class RedisGraph(Neo4J):
@@ -217,6 +633,12 @@ class RedisGraph(Neo4J):
         self.redis_conn = self.redis.Redis(host, port)
         self.graph = self.redisgraph.Graph('test', self.redis_conn)
 
+    def exec_read(self, query, **params):
+        return self.exec_query(query, **params)
+
+    def exec_query_stream(self, query, **params):
+        return iter(self.exec_query(query, **params))
+
     def exec_query(self, query, **params):
         result_set = self.graph.query(query).result_set
         var_names = set([name[0] for name in list(map(lambda x:x.decode('utf-8').split('.'), result_set[0]))])
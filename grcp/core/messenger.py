@@ -1,25 +1,33 @@
 """ Implmentation of the communication module to exchange messages between the
 controller and the client routers.
 """
-import os, json, logging
+import os, json, logging, struct
+import weakref
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    _dumps = lambda data: json.dumps(data).encode('utf-8')
 
 from twisted.internet import protocol, reactor
-from twisted.protocols.basic import LineReceiver
+from twisted.protocols.basic import LineReceiver, Int32StringReceiver
 
 logger = logging.getLogger('grcp.messenger')
 
 
-class RouterControlProtocol(LineReceiver):
-    """A protocol for communication with flow-based BGP routers."""
-
-    delimiter = b'\n'
+class _RouterControlMixin(object):
+    """Connection handling shared by the framings of the router protocol."""
 
     def __init__(self, factory):
         self.factory = factory
+        # framed messages waiting to be written with the next flush
+        self._pending = []
+        self._flush_scheduled = False
 
     def connectionMade(self):
         conn_id = self.transport.getPeer()
-        logger.debug('client connected: %r' % conn_id)
+        logger.debug('client connected: %r', conn_id)
         self.factory.connection_to_protocol_instance[conn_id] = self
 
     def connectionLost(self, reason):
@@ -27,30 +35,73 @@ class RouterControlProtocol(LineReceiver):
         self.factory.connection_to_protocol_instance.pop(conn_id, None)
         self.factory.handle_connection_lost(conn_id)
 
-    def lineReceived(self, data):
-        logger.debug('received data from the wire: %r' % data)
+    def messageReceived(self, data):
+        logger.debug('received data from the wire: %r', data)
         self.factory.receive(self.transport.getPeer(), data)
 
     def send(self, data):
-        logger.debug('sent data to the wire: %r' % data)
-        self.sendLine(data)
+        """Queue a message. Messages queued in the same reactor iteration are written
+        together with one writeSequence call."""
+        logger.debug('sent data to the wire: %r', data)
+        self._pending.extend(self._frame(data))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        self._flush_scheduled = False
+        if pending and self.transport is not None:
+            self.transport.writeSequence(pending)
+
+
+class RouterControlProtocol(_RouterControlMixin, LineReceiver):
+    """A protocol for communication with flow-based BGP routers. Messages are
+    separated by newlines."""
+
+    delimiter = b'\n'
+
+    def lineReceived(self, data):
+        self.messageReceived(data)
+
+    def _frame(self, data):
+        return (data, self.delimiter)
+
+
+class Int32RouterControlProtocol(_RouterControlMixin, Int32StringReceiver):
+    """The router protocol with each message prefixed by its length (4 bytes, big
+    endian) instead of followed by a newline, so that messages are cut without
+    scanning them."""
+
+    MAX_LENGTH = 1024 * 1024
+
+    def stringReceived(self, data):
+        self.messageReceived(data)
+
+    def _frame(self, data):
+        return (struct.pack(self.structFormat, len(data)), data)
 
 
 class MessengerServer(protocol.Factory):
 
-    def __init__(self, handle_data_received, handle_connection_lost):
-        self.connection_to_protocol_instance = {}
+    PROTOCOLS = {
+            'line': RouterControlProtocol,
+            'int32': Int32RouterControlProtocol,
+            }
+
+    def __init__(self, handle_data_received, handle_connection_lost, framing='line'):
+        self.protocol_class = self.PROTOCOLS[framing]
+        # peer address -> protocol, filled in by connectionMade. Entries of
+        # connections that went away without connectionLost are dropped by the GC
+        self.connection_to_protocol_instance = weakref.WeakValueDictionary()
         self.handle_data_received = handle_data_received
         self.handle_connection_lost = handle_connection_lost
 
     def buildProtocol(self, addr):
-        proto = RouterControlProtocol(self)
-        self.connection_to_protocol_instance[addr] = proto
-        return proto
+        return self.protocol_class(self)
 
     def receive(self, conn_id, data):
-        if type(data) == bytes:
-            data = data.decode('utf-8')
+        # data is handed over as bytes; the JSON decoders accept bytes directly
         self.handle_data_received(conn_id, data)
 
     def send(self, conn_id, data):
@@ -58,15 +109,18 @@ class MessengerServer(protocol.Factory):
         if proto:
             try:
                 if isinstance(data, dict):
-                    msg = json.dumps(data).encode('utf-8')
+                    msg = _dumps(data)
+                elif isinstance(data, bytes):
+                    msg = data
                 else:
                     msg = str(data).encode('utf-8')
-                reactor.callFromThread(lambda: proto.send(msg))
+                # only called from the controller's drain loop, outside the reactor
+                reactor.callFromThread(proto.send, msg)
                 return True
             except Exception as e:
-                logger.error('error encountered when sending %r to %r: %s' % (conn_id, data, e))
+                logger.error('error encountered when sending %r to %r: %s', conn_id, data, e)
         else:
-            logger.error('connection %s is disconnected' % conn_id)
+            logger.error('connection %s is disconnected', conn_id)
         return False
 
     def run_forever(self, bind_port):
@@ -3,44 +3,51 @@ Models based on Labeled Graph Property for BGP routing.
 
 """
 import copy
-import inspect
+import functools
 import logging
 import ipaddress
+import os
+import socket
+import sys
 import uuid
 
 from . import graphdb
 from . import query
 
+# str property values shorter than this are interned
+INTERN_MAX_LEN = 32
+
 
 class Property(object):
     """Base class for data object Property. A model can have many of these Property"""
 
-    _code_name = None # used for creating Cypher query
-    _name = None
-    _indexed = False # whether the Property will be indexed in the graph
-    _required = False
-    _default = None
-    _verbose_name = None
+    __slots__ = ('_code_name', '_name', '_indexed', '_required', '_default', '_verbose_name')
     _type = None
+    # values of this type are valid as they are; set for the classes that keep the
+    # plain type conversion of Property._validate
+    _exact_type = None
 
     def __init__(self, name=None, indexed=None, required=None,
                  default=None, verbose_name=None):
-        if name is not None:
-            self._name = name
-        if indexed is not None:
-            self._indexed = indexed
-        if required is not None:
-            self._required = required
-        if default is not None:
-            self._default = default
-        if verbose_name is not None:
-            self._verbose_name = verbose_name
+        self._code_name = None # used for creating Cypher query
+        self._name = name
+        self._indexed = bool(indexed) # whether the Property will be indexed in the graph
+        self._required = bool(required)
+        self._default = default
+        self._verbose_name = verbose_name
 
     def __new__(cls, *args, **kwargs):
         if cls == Property:
             raise Exception('Instantiation of Property class is not allowed.')
         return super(Property, cls).__new__(cls)
 
+    def __init_subclass__(cls, **kwargs):
+        super(Property, cls).__init_subclass__(**kwargs)
+        if cls._validate.__func__ is Property._validate.__func__:
+            cls._exact_type = cls._type
+        else:
+            cls._exact_type = None
+
     @classmethod
     def _validate(cls, value):
         """subclass should override this."""
@@ -48,7 +55,7 @@ class Property(object):
             return value
         try:
             value = cls._type(value)
-        except:
+        except (ValueError, TypeError):
             raise ValueError('%s accepts value typed %s; received: %r (%s)' % (
                              cls.__name__, cls._type, value, type(value)))
         return value
@@ -65,40 +72,41 @@ class Property(object):
     def _set_value(self, entity, value):
         if value is not None:
             value = self._validate(value)
+            # short strings (states, port names, addresses) repeat across many
+            # instances; keep one copy of each
+            if type(value) is str and len(value) < INTERN_MAX_LEN:
+                value = sys.intern(value)
         if self._required and value is None:
             raise ValueError('%s (%s) is required' % (self._name, self.__class__.__name__))
         entity._values[self._name] = value
 
+    def __set_name__(self, owner, name):
+        self._code_name = '%s.%s' % (owner.__name__, self._name)
+
     def __get__(self, obj, objclass):
-        """Override the default __get__ to change the _code_name as the variable name
-        of the attribute of the instance whose attribute member is being access.
+        """Return the value of the property of obj, or the Property itself when
+        accessed on the class. Each model class has its own Property objects whose
+        _code_name is the variable name used to generate Cypher queries.
         Eg:
-        class A():
+        class A(Model):
             attr = SomeProperty(name='my_name')
         print(A.attr._code_name)
         # result: A.my_name
-        We need this behaviour to generate Cypher queries on a model.
         """
-        if objclass is not None:
-            self._code_name = '.'.join((objclass.__name__, self._name))
         if obj is None:
             return self
         return self._get_value(obj)
 
-    def copy(self):
-        new = self.__class__(
-                self._name, self._indexed, self._required, self._default, self._verbose_name)
-        return new
-
     def _comparison(self, op, value):
         """get called when standard Python binary operator is used on a property to
         return a query.FilterNode.
         """
-        value = self._validate(value)
+        if type(value) is not self._exact_type:
+            value = self._validate(value)
         return query.FilterNode(self._code_name, op, value)
 
     def __hash__(self):
-        return hash((self.name, self._value, self.required))
+        return hash((self._code_name, self._name, self._required))
 
     def __eq__(self, value):
         return self._comparison('=', value)
@@ -134,11 +142,13 @@ class Property(object):
 
 class StringProperty(Property):
     """A StringProperty accepts only string value."""
+    __slots__ = ()
     _type = str
 
 
 class ListProperty(Property):
     """A ListProperty accepts only list typed value. Items in list can be scalar"""
+    __slots__ = ()
     _type = list
 
     def incl(self, item):
@@ -158,44 +168,48 @@ class ListProperty(Property):
 
 class NumberProperty(Property):
     """exist for type checing."""
-    pass
+    __slots__ = ()
 
 
 class IntegerProperty(NumberProperty):
+    __slots__ = ()
     _type = int
 
 
 class FloatProperty(NumberProperty):
+    __slots__ = ()
     _type = float
 
 
 class BandwidthProperty(FloatProperty):
     """Represent bandwidth (in bps) of a link."""
-    pass
+    __slots__ = ()
 
 
 class LossProperty(FloatProperty):
     """A loss is the sum of loss in all Links in the path."""
-    pass
+    __slots__ = ()
 
 
 class WeightProperty(FloatProperty):
     """Represent an IGP link weight."""
-    pass
+    __slots__ = ()
 
 
 class LatencyProperty(FloatProperty):
     """Represent link latency (ms)."""
-    pass
+    __slots__ = ()
 
 
 class CostProperty(FloatProperty):
     """Represent cost for sending traffic unit over an inter-AS link.
     This is used to model AS relationship."""
-    pass
+    __slots__ = ()
 
 
 class PreferenceProperty(IntegerProperty):
+    __slots__ = ()
+
     @classmethod
     def _validate(cls, value):
         value = super(PreferenceProperty, cls)._validate(value)
@@ -205,55 +219,140 @@ class PreferenceProperty(IntegerProperty):
 
 
 class MedProperty(IntegerProperty):
-    pass
+    __slots__ = ()
 
 
 class OriginProperty(IntegerProperty):
-
+    __slots__ = ()
     _CODES = {'incomplete': -1, 'igp': 0, 'egp': 1}
+    # names and codes, both mapped to the code
+    _ALL = {-1: -1, 0: 0, 1: 1, 'incomplete': -1, 'igp': 0, 'egp': 1}
 
     @classmethod
     def _validate(cls, value):
-        if isinstance(value, str) and value.lower() in cls._CODES:
-            return cls._CODES[value.lower()]
-        elif value in list(cls._CODES.values()):
-            return value
-        else:
+        key = value.lower() if isinstance(value, str) else value
+        try:
+            return cls._ALL[key]
+        except (KeyError, TypeError):
             raise ValueError(
                 'OriginProperty accepts value of integer or string:-1 (incomplete), '\
                 '0 (igp), 1 (egp); received: %r' % value)
 
 
+_IPV4_PREFIX_LENGTHS = {str(length): length for length in range(33)}
+_IPV6_PREFIX_LENGTHS = {str(length): length for length in range(129)}
+
+
+def _canonical_ipv6(address):
+    """Return address packed if it is an IPv6 address written the way ipaddress
+    writes it, else None. Forms with an embedded IPv4 address are left out, as
+    ipaddress and inet_ntop do not agree on them."""
+    if '.' in address:
+        return None
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, address)
+    except (OSError, ValueError):
+        return None
+    if socket.inet_ntop(socket.AF_INET6, packed) != address:
+        return None
+    return packed
+
+
+# the same nexthops and prefixes come again and again in route updates, so their
+# parsed forms are cached. IPv4 strings, the common case, are checked with
+# inet_pton, which only accepts the canonical dotted form, and IPv6 strings that
+# are already canonical (e.g. read back from the database) are accepted as they
+# are; anything else is left to ipaddress
+@functools.lru_cache(maxsize=4096)
+def _parse_ip(value):
+    if isinstance(value, str):
+        if ':' not in value:
+            try:
+                socket.inet_pton(socket.AF_INET, value)
+            except (OSError, ValueError):
+                raise ValueError('invalid IPv4 address: %r' % value)
+            return str(value)
+        if _canonical_ipv6(value) is not None:
+            return str(value)
+    return str(ipaddress.ip_address(value))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_prefix(value):
+    if isinstance(value, str):
+        address, slash, length = value.partition('/')
+        if ':' not in address:
+            length = _IPV4_PREFIX_LENGTHS.get(length if slash else '32')
+            if length is not None:
+                try:
+                    packed = socket.inet_pton(socket.AF_INET, address)
+                except (OSError, ValueError):
+                    raise ValueError('invalid IPv4 prefix: %r' % value)
+                if int.from_bytes(packed, 'big') & (0xffffffff >> length):
+                    raise ValueError('%r has host bits set' % value)
+                return '%s/%d' % (address, length)
+        else:
+            length = _IPV6_PREFIX_LENGTHS.get(length if slash else '128')
+            packed = _canonical_ipv6(address)
+            if length is not None and packed is not None:
+                if int.from_bytes(packed, 'big') & ((1 << (128 - length)) - 1):
+                    raise ValueError('%r has host bits set' % value)
+                return '%s/%d' % (address, length)
+    return str(ipaddress.ip_network(value))
+
+
 class IPAddressProperty(Property):
+    __slots__ = ()
+
     @classmethod
     def _validate(cls, value):
+        if isinstance(value, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            return str(value)
         try:
-            address = ipaddress.ip_address(value)
-            return str(address)
-        except:
+            return _parse_ip(value)
+        except (ValueError, TypeError):
             raise ValueError(
-                '%s requires a valid IP address; received %r (%s)' % (cls._name, value, type(value)))
+                '%s requires a valid IP address; received %r (%s)' % (cls.__name__, value, type(value)))
 
 
 class PrefixProperty(Property):
+    __slots__ = ()
+
     @classmethod
     def _validate(cls, value):
+        if isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            return str(value)
         try:
-            prefix = ipaddress.ip_network(value)
-            return str(prefix)
-        except:
+            return _parse_prefix(value)
+        except (ValueError, TypeError):
             raise ValueError(
-                '%s requires a valid IP prefix; received %r (%s)' % (cls._name, value, type(value)))
+                '%s requires a valid IP prefix; received %r (%s)' % (cls.__name__, value, type(value)))
+
+
+# random UIDs are made this many at a time, from one read of os.urandom
+UID_POOL_SIZE = 1024
+_uid_pool = []
+if hasattr(os, 'register_at_fork'):
+    # a child process must not hand out the UIDs of its parent
+    os.register_at_fork(after_in_child=_uid_pool.clear)
 
 
 class UIDProperty(Property):
+    __slots__ = ()
     _type = uuid.UUID
 
     @classmethod
     def generate(cls):
-        return str(uuid.uuid4())
+        """Return a random (version 4) UUID string."""
+        try:
+            return _uid_pool.pop()
+        except IndexError:
+            buf = os.urandom(16 * UID_POOL_SIZE)
+            _uid_pool.extend([str(uuid.UUID(bytes=buf[i:i + 16], version=4))
+                              for i in range(16, len(buf), 16)])
+            return str(uuid.UUID(bytes=buf[:16], version=4))
 
-    classmethod
+    @classmethod
     def _validate(cls, value):
         try:
             if isinstance(value, str):
@@ -264,65 +363,162 @@ class UIDProperty(Property):
                 value = uuid.UUID(bytes=value)
             if isinstance(value, uuid.UUID):
                 return str(value)
-        except:
-            raise ValueError('%s requires a valid UUID; received %r' % (cls._name, value))
-
-
-class Model(object):
+        except (ValueError, TypeError, AttributeError):
+            raise ValueError('%s requires a valid UUID; received %r' % (cls.__name__, value))
+
+
+@functools.lru_cache(maxsize=256)
+def _filter_template(name, keys):
+    return ' AND '.join(['%s.%s=$%s_%s' % (name, k, name, k) for k in keys])
+
+
+def _compile_get_values(descriptors):
+    """Return a _get_values function specialized for the given property descriptors,
+    equivalent to Model._get_values but with the loop over them unrolled."""
+    lines = ['def _get_values(self):', '    stored = self._values', '    values = {}']
+    for name, prop in descriptors.items():
+        lines.append('    if %r in stored:' % prop._name)
+        lines.append('        value = stored[%r]' % prop._name)
+        lines.append('        if value is not None:')
+        lines.append('            values[%r] = value' % name)
+        if prop._required:
+            lines.append('        else:')
+            lines.append('            raise ValueError(%r)' % ('%s is required but not set.' % name))
+    lines.append('    return values')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['_get_values']
+
+
+def _compile_from_properties(cls, descriptors):
+    """Return a function building an instance of cls from a dict of its property
+    values, equivalent to cls(**properties) with the defaults and required
+    properties checked by straight-line code."""
+    namespace = {'new': object.__new__, 'cls': cls, 'descriptors': descriptors,
+                 'set_values': cls._values.__set__, 'generate': UIDProperty.generate}
+    lines = ['def _from_properties(properties):',
+             '    self = new(cls)',
+             '    values = {}',
+             '    set_values(self, values)',
+             '    if "uid" not in properties:',
+             '        descriptors["uid"]._set_value(self, generate())',
+             '    for name, value in properties.items():',
+             '        prop = descriptors.get(name)',
+             '        if prop is None:',
+             '            raise AttributeError("Attribute %s cannot be set." % name)',
+             '        prop._set_value(self, value)']
+    for i, (name, prop) in enumerate(descriptors.items()):
+        namespace['prop%d' % i] = prop
+        if prop._default is not None:
+            lines.append('    if %r not in values:' % prop._name)
+            lines.append('        prop%d._set_value(self, prop%d._default)' % (i, i))
+        if prop._required:
+            lines.append('    if %r not in values:' % prop._name)
+            lines.append('        raise AttributeError(%r)' % (
+                         'Property %s is required but not set.' % name))
+    lines.append('    return self')
+    exec('\n'.join(lines), namespace)
+    return namespace['_from_properties']
+
+
+class ModelMeta(type):
+    """Collect the Property descriptors of a model class, including inherited ones,
+    and its labels once when the class is created."""
+
+    def __init__(cls, name, bases, namespace):
+        super(ModelMeta, cls).__init__(name, bases, namespace)
+        descriptors = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if isinstance(value, Property):
+                    descriptors[attr] = value
+                else:
+                    descriptors.pop(attr, None)
+        # the class's own descriptors were named by __set_name__; inherited ones are
+        # copied so that each class names its own for Cypher queries (e.g.
+        # Border.routerid), once here rather than on every access
+        for attr, prop in descriptors.items():
+            if attr not in namespace:
+                prop = copy.copy(prop)
+                prop.__set_name__(cls, attr)
+                setattr(cls, attr, prop)
+                descriptors[attr] = prop
+        cls._property_descriptors = descriptors
+        if '_get_values' not in namespace:
+            cls._get_values = _compile_get_values(descriptors)
+        # used by entity_to_model, which reads many instances at a time
+        cls._from_properties = staticmethod(_compile_from_properties(cls, descriptors))
+        labelled = [klass for klass in cls.__mro__
+                    if isinstance(klass, ModelMeta) and not klass._base_class]
+        cls._label_set = frozenset([klass.__name__ for klass in labelled])
+        # (label, property name) of each unique property, used by create_constraints
+        cls._indexed_properties = tuple([
+                (klass.__name__, attr) for klass in labelled
+                for attr, prop in klass._property_descriptors.items() if prop._indexed])
+        # the label (or relationship type) of the entities of this class; unset for
+        # the abstract models below
+        cls._model_label = name
+
+
+class Model(object, metaclass=ModelMeta):
     """A model represents an element in the network e.g. Router, Link and so on.
     When define a subclass put _ before a property to exclude from the database.
+    The models defined in this module are slotted and cannot hold such attributes;
+    subclass them to add some.
     """
+    __slots__ = ('_values',)
     _gdb = None
-    _values = None
-    _properties = None
     _base_class = True
 
     uid = UIDProperty(name='uid', indexed=True, required=True)
     state = StringProperty(name='state', default='down')
 
     def __new__(cls, *args, **kwargs):
-        if cls in [Model, Node, Router, Edge, Link, Path]:
+        if cls in _abstract_models:
             raise TypeError('Cannot create model %s, only subclass allowed.' % cls)
         return super(Model, cls).__new__(cls)
 
     def __init__(self, *args, **kwargs):
         self._values = {}
-        self._properties = {}
         if 'uid' not in kwargs:
             kwargs['uid'] = UIDProperty.generate()
         for name, value in kwargs.items():
             setattr(self, name, value)
-        for name, prop in inspect.getmembers(self.__class__):
-            if isinstance(prop, Property):
-                if name not in self._properties and prop._default is not None:
-                    setattr(self, name, prop._default)
-                if prop._required and name not in self._properties:
-                    raise AttributeError('Property %s is required but not set.' % name)
+        values = self._values
+        for name, prop in self._property_descriptors.items():
+            if prop._name not in values and prop._default is not None:
+                prop._set_value(self, prop._default)
+            if prop._required and prop._name not in values:
+                raise AttributeError('Property %s is required but not set.' % name)
 
     @property
     def properties(self):
-        """return a dict of Property"""
-        return self._properties
+        """return a dict of the Property set on this instance, by name"""
+        return {name: prop for name, prop in self._property_descriptors.items()
+                if prop._name in self._values}
 
     def __setattr__(self, name, value):
         """override the default setattr method so we can correctly set property for each instance."""
         if name.startswith('_'):
-            self.__dict__[name] = value
+            try:
+                object.__setattr__(self, name, value)
+            except AttributeError:
+                raise AttributeError('%s has no __dict__, subclass it to set attribute %s.'
+                                     % (type(self).__name__, name))
             return
-        prop = getattr(self.__class__, name)
-        if not isinstance(prop, Property):
+        # the descriptors are shared by all instances, only the value is stored
+        prop = self._property_descriptors.get(name)
+        if prop is None:
             raise AttributeError('Attribute %s cannot be set.' % name)
-        prop = prop.copy()
         prop._set_value(self, value)
-        self._properties[name] = prop
 
     def _get_values(self):
         """Return a dict of all property names and their values."""
         values = {}
-        for name, prop in self._properties.items():
-            if not isinstance(prop, Property):
+        for name, prop in self._property_descriptors.items():
+            if prop._name not in self._values:
                 continue
-            value = prop._get_value(self)
+            value = self._values[prop._name]
             if prop._required and value is None:
                 raise ValueError('%s is required but not set.' % name)
             if value is not None:
@@ -331,11 +527,8 @@ class Model(object):
 
     @classmethod
     def default_values(cls):
-        values = {}
-        for name, prop in inspect.getmembers(cls):
-            if isinstance(prop, Property) and prop._default is not None:
-                values[name] = prop._default
-        return values
+        return {name: prop._default for name, prop in cls._property_descriptors.items()
+                if prop._default is not None}
 
     @classmethod
     def query(cls, *args, **kwargs):
@@ -352,9 +545,7 @@ class Model(object):
     @classmethod
     def _cls_names(cls):
         """Return all class names in the hierarchy except base classes'."""
-        names = [cl.__name__ for cl in inspect.getmro(cls)
-                if issubclass(cl, Model) and not cl._base_class]
-        return set(names)
+        return cls._label_set
 
     def match_dict(self):
         """override this if required in subclass."""
@@ -376,20 +567,19 @@ class Model(object):
         properties = dict(entity)
         properties.update(kwargs)
         if isinstance(entity, cls._gdb.Node):
-            modelclass = None
-            for label in list(entity.labels):
-                if label in _all_models:
-                    modelclass = _all_models[label]
-                    break
-            if modelclass is not None:
-                new = modelclass(**properties)
-                return new
-            else:
+            labels = entity.labels
+            # usually the entity is of the class it is read for
+            if cls._model_label in labels:
+                return cls._from_properties(properties)
+            modelclass = next(filter(None, map(_all_models.get, labels)), None)
+            if modelclass is None:
                 raise Exception('model not found')
+            return modelclass._from_properties(properties)
         elif isinstance(entity, cls._gdb.Relationship):
+            if entity.type == cls._model_label:
+                return cls._from_properties(properties)
             modelclass = _all_models[entity.type]
-            new = modelclass(**properties)
-            return new
+            return modelclass._from_properties(properties)
         return entity
 
     @classmethod
@@ -402,16 +592,12 @@ class Model(object):
 
     @classmethod
     def dict_to_cypher(cls, name, d):
-        """ turn this dict d into a cypher string. name is variable used in cypher query
+        """ turn this dict d into a cypher condition on query parameters. name is
+        variable used in cypher query. Return the condition and the parameters.
+        Ex: ('src', {'uid': 1}) -> ('src.uid=$src_uid', {'src_uid': 1})
         """
-        filters = []
-        for k, v in d.items():
-            k = '%s.%s' % (name, k)
-            if type(v) == str:
-                filters.append('%s="%s"' % (k, v))
-            else:
-                filters.append('%s=%s' % (k, v))
-        return ' AND '.join(filters)
+        keys = tuple([k for k in d if k != 'label'])
+        return _filter_template(name, keys), {'%s_%s' % (name, k): d[k] for k in keys}
 
     def __str__(self):
         return '<%s %s>' % (self.__class__.__name__, self._get_values())
@@ -419,15 +605,12 @@ class Model(object):
 
     @classmethod
     def create_constraints(cls):
-        for cl in inspect.getmro(cls):
-            if issubclass(cl, Model) and not cl._base_class:
-                for name, prop in inspect.getmembers(cl):
-                    if isinstance(prop, Property) and prop._indexed:
-                        cls._gdb.create_constraint(cl.__name__, name)
+        cls._gdb.create_constraints(cls._indexed_properties)
 
 
 class Node(Model):
     """Represent a routing node in graph."""
+    __slots__ = ()
     name = StringProperty(name='name')
 
     @classmethod
@@ -439,26 +622,37 @@ class Node(Model):
             op = '>='
         query = 'MATCH {name} WHERE ({name})-[r]-() WITH {name}, COUNT(r) as c'\
                 'WHERE c {op} {degree} RETRUN {name}'.format(name=cls.__name__, degree=degree, op=op)
-        records = cls._gdb.exec_query(query)
-        for record in records:
+        for record in cls._gdb.exec_query_stream(query):
             yield cls.neo4j_to_model(record)
 
     @classmethod
     def count(cls):
         """Return number of nodes of this class."""
-        record = list(cls._gdb.exec_query('MATCH (n) RETURN COUNT(n) as count'))
+        record = cls._gdb.exec_read('MATCH (n) RETURN COUNT(n) as count')
         if record:
             return record[0]['count']
 
     @classmethod
     def node_by_id(cls, uid):
         """Return a node by UID."""
-        early_filter = {'uid': str(uid)}
-        nodes = list(cls.query(early_filter=early_filter).fetch(limit=1))
+        early_filter, params = cls.dict_to_cypher(cls.__name__, {'uid': str(uid)})
+        nodes = list(cls.query(early_filter=early_filter, params=params).fetch(limit=1))
         if nodes:
             return nodes[0]
         return None
 
+    @classmethod
+    def find_many(cls, values, key='uid'):
+        """Return the nodes of this class whose property key is one of values, read
+        in a single query. Ex: Border.find_many(['1.1.1.1', '2.2.2.2'], key='routerid')
+        """
+        prop = cls._property_descriptors.get(key)
+        if prop is None:
+            raise AttributeError('%s has no property %s' % (cls.__name__, key))
+        values = [prop._validate(value) for value in values]
+        records = cls._gdb.get_nodes_by_values(cls.__name__, prop._name, values)
+        return [cls.entity_to_model(record['node']) for record in records]
+
     def put(self):
         """Save to the database."""
         properties = self._get_values()
@@ -471,9 +665,30 @@ class Node(Model):
             return self.entity_to_model(record)
         return None
 
+    @classmethod
+    def put_many(cls, instances):
+        """Batch version of put: save many instances of this class in a single query.
+        Their match_dicts must have the same keys.
+
+        :rtype: list of the saved instances
+        """
+        if not instances:
+            return []
+        labels = list(cls._cls_names())
+        if not labels:
+            raise ValueError('No labels associated with this class %s' % cls.__name__)
+        rows = []
+        for instance in instances:
+            if type(instance) is not cls:
+                raise TypeError('put_many of %s received %r' % (cls.__name__, instance))
+            rows.append({'match': instance.match_dict(), 'properties': instance._get_values()})
+        records = cls._gdb.create_nodes(labels, rows)
+        return [cls.entity_to_model(record) for record in records]
+
     def delete(self):
-        record = self._gdb.delete_node(kind=self.__class__.__name__, match={'uid': self.uid})
-        return record is not None
+        deleted = self._gdb.delete_node(
+                kind=self.__class__.__name__, match={'uid': self.uid}, fetch=False)
+        return bool(deleted)
 
     @classmethod
     def get_or_create(cls, match_dict, **kwargs):
@@ -493,9 +708,29 @@ class Node(Model):
             return cls.entity_to_model(record)
         return None
 
+    @classmethod
+    def get_or_create_many(cls, rows):
+        """Batch version of get_or_create in a single query.
+
+        :param rows: list of (match_dict, properties); all match_dicts must have
+            the same keys
+        :rtype: list of instances of this class
+        """
+        defaults = cls.default_values()
+        batch = []
+        for match_dict, kwargs in rows:
+            properties = dict(defaults)
+            properties.update(kwargs)
+            if 'uid' not in properties:
+                properties['uid'] = UIDProperty.generate()
+            batch.append({'match': match_dict, 'properties': properties})
+        records = cls._gdb.create_nodes(list(cls._cls_names()), batch)
+        return [cls.entity_to_model(record) for record in records]
+
 
 class Router(Node):
     """A model represents a BGP Router."""
+    __slots__ = ()
     _base_class = False
 
     # for a Neighbor routerid is the IP of the neighbor which it uses to establish
@@ -527,6 +762,7 @@ class Router(Node):
 
 class Border(Router):
     """ Represent a border router of the ISP."""
+    __slots__ = ()
     _base_class = False
 
     local_as = IntegerProperty(name='local_as')
@@ -541,6 +777,7 @@ class Border(Router):
 
 class Neighbor(Router):
     """Represent a router belonging to a neighbor."""
+    __slots__ = ()
     _base_class = False
 
     peer_ip = IPAddressProperty(name='peer_ip', required=True)
@@ -563,6 +800,7 @@ class Neighbor(Router):
 
 class Prefix(Node):
     """Represent a destination prefix."""
+    __slots__ = ()
     _base_class = False
 
     prefix = PrefixProperty(name='prefix', required=True, indexed=True)
@@ -582,8 +820,14 @@ class Prefix(Node):
         kwargs['prefix'] = prefix
         return super(Prefix, cls).get_or_create({'prefix': prefix}, **kwargs)
 
+    @classmethod
+    def get_or_create_many(cls, prefixes, **kwargs):
+        rows = [({'prefix': prefix}, dict(kwargs, prefix=prefix)) for prefix in prefixes]
+        return super(Prefix, cls).get_or_create_many(rows)
+
 
 class Nexthop(Node):
+    __slots__ = ()
     _base_class = False
 
     nexthop = IPAddressProperty('nexthop', required=True, indexed=True)
@@ -596,6 +840,11 @@ class Nexthop(Node):
         kwargs['nexthop'] = nexthop
         return super(Nexthop, cls).get_or_create({'nexthop': nexthop}, **kwargs)
 
+    @classmethod
+    def get_or_create_many(cls, nexthops, **kwargs):
+        rows = [({'nexthop': nexthop}, dict(kwargs, nexthop=nexthop)) for nexthop in nexthops]
+        return super(Nexthop, cls).get_or_create_many(rows)
+
     @classmethod
     def get_and_delete(cls, nexthop):
         match = {'nexthop': nexthop}
@@ -610,22 +859,36 @@ class Nexthop(Node):
 
 class Edge(Model):
     """Represent an edge in graph. Exist mainly to check type."""
+    __slots__ = ()
     src = UIDProperty('src', verbose_name='uid of src node', required=True)
     dst = UIDProperty('dst', verbose_name='uid of dst node', required=True)
     state = StringProperty(name='state', default='down')
+    # labels of the src and dst nodes if known, so that matching them by uid can
+    # use the index on the label instead of scanning all nodes
+    _src_kind = None
+    _dst_kind = None
+
+    @classmethod
+    def _uid_matches(cls, src_uid, dst_uid):
+        src = {'uid': src_uid}
+        dst = {'uid': dst_uid}
+        if cls._src_kind:
+            src['label'] = cls._src_kind
+        if cls._dst_kind:
+            dst['label'] = cls._dst_kind
+        return src, dst
 
     @classmethod
     def count(cls):
-        record = list(cls._gdb.exec_query(
-                'MATCH (n)-[r : {kind}]->() RETURN COUNT(r) as count'.format(cls.__name__)))
+        record = cls._gdb.exec_read(
+                'MATCH (n)-[r : {kind}]->() RETURN COUNT(r) as count'.format(kind=cls.__name__))
         if record:
             return record[0]['count']
 
     def put(self):
         """Save to the database."""
         properties = self._get_values()
-        src = { 'uid': properties.pop('src') }
-        dst = { 'uid': properties.pop('dst') }
+        src, dst = self._uid_matches(properties.pop('src'), properties.pop('dst'))
         kind = self.__class__.__name__
         record = self._gdb.create_link(kind=kind, src=src, dst=dst,
                                        properties=properties)
@@ -633,8 +896,31 @@ class Edge(Model):
             return self.neo4j_to_model(record)
         return None
 
+    @classmethod
+    def put_many(cls, instances):
+        """Batch version of put: save many links of this class in a single query.
+
+        :rtype: list of the saved instances
+        """
+        if not instances:
+            return []
+        rows = []
+        for instance in instances:
+            if type(instance) is not cls:
+                raise TypeError('put_many of %s received %r' % (cls.__name__, instance))
+            properties = instance._get_values()
+            src, dst = cls._uid_matches(properties.pop('src'), properties.pop('dst'))
+            rows.append({'src': src, 'dst': dst, 'properties': properties})
+        records = cls._gdb.create_links(cls.__name__, rows)
+        return [cls.neo4j_to_model(record) for record in records]
+
     @classmethod
     def get_or_create(cls, src_match, dst_match, **kwargs):
+        return cls._get_or_create(src_match, dst_match, kwargs)
+
+    @classmethod
+    def _get_or_create(cls, src_match, dst_match, kwargs):
+        """get_or_create with the properties in a dict, which is modified."""
         for attr, value in list(kwargs.items()):
             value = getattr(cls, attr)._validate(value)
             kwargs.pop(attr)
@@ -647,6 +933,27 @@ class Edge(Model):
             return cls.neo4j_to_model(record)
         return None
 
+    @classmethod
+    def get_or_create_many(cls, rows):
+        """Batch version of get_or_create in a single query.
+
+        :param rows: list of (src_match, dst_match, properties); all src_match (and
+            dst_match) must have the same keys
+        :rtype: list of instances of this class
+        """
+        batch = []
+        for src_match, dst_match, kwargs in rows:
+            properties = {}
+            for attr, value in kwargs.items():
+                value = getattr(cls, attr)._validate(value)
+                if value is not None:
+                    properties[attr] = value
+            if 'uid' not in properties:
+                properties['uid'] = UIDProperty.generate()
+            batch.append({'src': src_match, 'dst': dst_match, 'properties': properties})
+        records = cls._gdb.create_links(cls.__name__, batch)
+        return [cls.neo4j_to_model(record) for record in records]
+
     @classmethod
     def update(cls, src_match, dst_match, **kwargs):
         record = cls._gdb.update_link(cls.__name__, src_match, dst_match, kwargs)
@@ -655,11 +962,10 @@ class Edge(Model):
         return None
 
     def delete(self):
-        src = { 'uid': self.src }
-        dst = { 'uid': self.dst }
-        label = self.__class__.__name__
-        ret = self._gdb.delete_link(kind=self.__class__.__name__, src=src, dst=dst)
-        return ret is not None
+        src, dst = self._uid_matches(self.src, self.dst)
+        deleted = self._gdb.delete_link(
+                kind=self.__class__.__name__, src=src, dst=dst, fetch=False)
+        return bool(deleted)
 
     @classmethod
     def get_and_delete(self, src_match, dst_match):
@@ -696,27 +1002,37 @@ class Edge(Model):
         src_label = None
         dst_label = None
         early_filter = []
+        params = {}
+        # the label is read with get and skipped by dict_to_cypher, so that the
+        # caller's dicts are left as they are
         if 'src' in kwargs:
             src = kwargs.pop('src')
-            src_label = src.pop('label', None)
-            if src:
-                early_filter.append(cls.dict_to_cypher('src', src))
+            src_label = src.get('label')
+            if set(src) - {'label'}:
+                cond, src_params = cls.dict_to_cypher('src', src)
+                early_filter.append(cond)
+                params.update(src_params)
         if 'dst' in kwargs:
             dst = kwargs.pop('dst')
-            dst_label = dst.pop('label', None)
-            if dst:
-                early_filter.append(cls.dict_to_cypher('dst', dst))
+            dst_label = dst.get('label')
+            if set(dst) - {'label'}:
+                cond, dst_params = cls.dict_to_cypher('dst', dst)
+                early_filter.append(cond)
+                params.update(dst_params)
         early_filter = ' AND '.join(early_filter)
         kind = kwargs.pop('kind') if 'kind' in kwargs else cls
         qry = query.Query(
                 cls._gdb, kind=kind, src_label=src_label, dst_label=dst_label,
-                early_filter=early_filter, **kwargs)
+                early_filter=early_filter, params=params, **kwargs)
         return qry.filter(*args)
 
 
 class Route(Edge):
     """Represent a route."""
+    __slots__ = ()
     _base_class = False
+    _src_kind = Nexthop.__name__
+    _dst_kind = Prefix.__name__
 
     local_pref = PreferenceProperty('local_pref', default=100)
     as_path = ListProperty('as_path', default=[])
@@ -731,6 +1047,17 @@ class Route(Edge):
         dst_match = {'prefix': prefix, 'label': Prefix.__name__}
         return super(Route, cls).get_or_create(src_match, dst_match, **properties)
 
+    @classmethod
+    def get_or_create_many(cls, routes):
+        """routes is a list of (neighbor, prefix, properties)"""
+        rows = []
+        for neighbor, prefix, properties in routes:
+            properties['prefix'] = prefix
+            rows.append(({'nexthop': neighbor, 'label': Nexthop.__name__},
+                         {'prefix': prefix, 'label': Prefix.__name__},
+                         properties))
+        return super(Route, cls).get_or_create_many(rows)
+
     @classmethod
     def update(cls, nexthop, prefix, **properties):
         src_match = {'nexthop': nexthop, 'label': Nexthop.__name__}
@@ -740,7 +1067,10 @@ class Route(Edge):
 
 class Session(Edge):
     """Represent a BGP session between a Border and a Neighbor."""
+    __slots__ = ()
     _base_class = False
+    _src_kind = Border.__name__
+    _dst_kind = Neighbor.__name__
 
     @classmethod
     def get_or_create(cls, border, neighbor, **properties):
@@ -751,6 +1081,7 @@ class Session(Edge):
 
 class Link(Edge):
     """Represent a data-plane link between two Nodes. A link is directional."""
+    __slots__ = ()
     _base_class = False
 
     loss = LossProperty('loss', default=0)
@@ -771,13 +1102,15 @@ class Link(Edge):
 
     @classmethod
     def update(cls, src_uid, dst_uid, **properties):
-        src_match = {'uid': src_uid}
-        dst_match = {'uid': dst_uid}
+        src_match, dst_match = cls._uid_matches(src_uid, dst_uid)
         return super(Link, cls).update(src_match, dst_match, **properties)
 
 
 class IntraLink(Link):
     """Represent link Border --> Border."""
+    __slots__ = ()
+    _src_kind = Border.__name__
+    _dst_kind = Border.__name__
     weight = WeightProperty('weight')
 
     @classmethod
@@ -789,6 +1122,10 @@ class IntraLink(Link):
 
 class InterIngress(Link):
     """Represent ingress link Nexthop --> Border."""
+    __slots__ = ()
+    _src_kind = Nexthop.__name__
+    _dst_kind = Border.__name__
+
     @classmethod
     def get_or_create(cls, nexthop, border, **properties):
         src_match = {'nexthop': nexthop, 'label': Nexthop.__name__}
@@ -798,6 +1135,9 @@ class InterIngress(Link):
 
 class InterEgress(Link):
     """Represent egress link Border --> Nexthop."""
+    __slots__ = ()
+    _src_kind = Border.__name__
+    _dst_kind = Nexthop.__name__
     cost = CostProperty('cost', verbose_name='transit cost')
     pathid = IntegerProperty(name='pathid', required=True)
 
@@ -810,10 +1150,11 @@ class InterEgress(Link):
 
 class Advertise(Edge):
     """Represent that a Neighbor has advertised a Nexthop."""
+    __slots__ = ()
     _base_class = False
 
 
-class PathProperty(type):
+class PathProperty(ModelMeta):
     """Use to override class attribute access.
     A path has following attributes:
     - intra_util: utilization of the intra link
@@ -856,6 +1197,7 @@ class PathProperty(type):
 
 class Path(Edge, metaclass=PathProperty):
     """ Exist for queyring only."""
+    __slots__ = ()
     def put(self):
         raise Exception('Not allowed')
 
@@ -868,14 +1210,19 @@ class Path(Edge, metaclass=PathProperty):
 
     @classmethod
     def query(cls, routerid, prefix, for_peer=False):
+        if cls._gdb is None:
+            raise RuntimeError('Intialize the model first. Require an accessible Neo4J')
+        # the filter is always the same, only its parameters change
         label = Neighbor.__name__ if for_peer else Border.__name__
-        src_match = {'routerid': routerid, 'label': label}
-        dst_match = {'prefix': prefix, 'label': Prefix.__name__}
-        return super(Path, cls).query(src=src_match, dst=dst_match)
+        return query.Query(
+                cls._gdb, kind=cls, src_label=label, dst_label=Prefix.__name__,
+                early_filter='src.routerid=$src_routerid AND dst.prefix=$dst_prefix',
+                params={'src_routerid': routerid, 'dst_prefix': prefix})
 
 
 class Mapping(Edge):
     """Represent a RIB/FIB entry of a node. A mapping links a node to a prefix"""
+    __slots__ = ()
     load = FloatProperty(name='load', default=0)
     prefix = PrefixProperty(name='prefix')
     ingress = StringProperty(name='ingress')
@@ -894,28 +1241,101 @@ class Mapping(Edge):
             return self.neo4j_to_model(record)
 
     @classmethod
-    def get_or_create(cls, routerid, prefix, properties={}, for_peer=False):
+    def get_or_create(cls, routerid, prefix, properties=None, for_peer=False):
         label = Neighbor.__name__ if for_peer else Border.__name__
         src_match = {'routerid': routerid, 'label': label}
         dst_match = {'prefix': prefix, 'label': Prefix.__name__}
-        properties['prefix'] = prefix
-        return super(Mapping, cls).get_or_create(src_match, dst_match, **properties)
+        # the caller's dict is left as it is
+        properties = dict(properties or (), prefix=prefix)
+        return cls._get_or_create(src_match, dst_match, properties)
+
+    @classmethod
+    def find_by_pairs(cls, pairs):
+        """Return the mappings of many (routerid, prefix) pairs, read in a single
+        query. The routerid is of either a border or a peer."""
+        pairs = [(Router.routerid._validate(routerid), Prefix.prefix._validate(prefix))
+                 for routerid, prefix in pairs]
+        records = cls._gdb.get_links_by_pairs(
+                cls.__name__, pairs, src_kind=Router.__name__, dst_kind=Prefix.__name__,
+                src_key='routerid', dst_key='prefix')
+        return [cls.neo4j_to_model(record) for record in records]
+
+    @classmethod
+    def get_or_create_many(cls, rows):
+        """Batch version of get_or_create. rows is a list of (routerid, prefix,
+        properties, for_peer). The mappings of borders and of peers are written with
+        one query each, in one transaction.
+
+        :rtype: list of instances of this class, in the order of rows; rows whose
+            router or prefix does not exist are left out
+        """
+        groups = {False: [], True: []}
+        for index, (routerid, prefix, properties, for_peer) in enumerate(rows):
+            label = Neighbor.__name__ if for_peer else Border.__name__
+            src_match = {'routerid': routerid, 'label': label}
+            dst_match = {'prefix': prefix, 'label': Prefix.__name__}
+            properties = dict(properties or (), prefix=prefix)
+            groups[bool(for_peer)].append((index, (src_match, dst_match, properties)))
+        mappings = []
+        with transaction():
+            for group in groups.values():
+                if not group:
+                    continue
+                created = super(Mapping, cls).get_or_create_many([row for _, row in group])
+                # the mappings of a group come in the order of its rows, less the rows
+                # left out, so each is matched to the next row of the same prefix
+                created = iter(created)
+                mapping = next(created, None)
+                for index, (_, _, properties) in group:
+                    if mapping is None:
+                        break
+                    if mapping.prefix == cls.prefix._validate(properties['prefix']):
+                        mappings.append((index, mapping))
+                        mapping = next(created, None)
+        mappings.sort(key=lambda item: item[0])
+        return [mapping for _, mapping in mappings]
 
 
 def initialize(neo4j_uri=None, neo4j_user=None, neo4j_pass=None):
     """Start the interface to graphdb."""
     Model._gdb = graphdb.Neo4J(db_uri=neo4j_uri, db_user=neo4j_user, db_pass=neo4j_pass)
-    Border.create_constraints()
-    Neighbor.create_constraints()
-    Prefix.create_constraints()
-    Nexthop.create_constraints()
+    # the constraints of all models are created together
+    Model._gdb.create_constraints([
+            pair for cls in (Border, Neighbor, Prefix, Nexthop)
+            for pair in cls._indexed_properties])
 
 def warm_up():
-    Model._gdb.exec_query('MATCH (n) OPTIONAL MATCH (n)-[r]->() RETURN COUNT(n.uid) + COUNT(r.uid);')
+    """Load the graph into the page cache of Neo4j. With APOC installed this is
+    done by apoc.warmup.run, which also loads the property stores and indexes;
+    otherwise by reading every node and relationship. (Neo4j Enterprise can also
+    do this itself at start-up, see dbms.memory.pagecache.warmup.enable.)"""
+    try:
+        Model._gdb.exec_query('CALL apoc.warmup.run($properties, $dynamic, $indexes)',
+                              properties=True, dynamic=True, indexes=True)
+    except Model._gdb.ClientError:
+        Model._gdb.exec_query(
+                'MATCH (n) OPTIONAL MATCH (n)-[r]->() RETURN COUNT(n.uid) + COUNT(r.uid);')
 
 def clear():
     Model._gdb.clear_db()
 
+def transaction():
+    """Return a context manager that runs all model operations of the block in
+    one transaction."""
+    return Model._gdb.transaction()
+
+def close():
+    """Release the connection to graphdb."""
+    if Model._gdb is not None:
+        Model._gdb.close()
+        Model._gdb = None
+
+
+# models that only exist to be subclassed
+_abstract_models = frozenset([Model, Node, Router, Edge, Link, Path])
+for _model in _abstract_models:
+    _model._model_label = None
+del _model
 
 _all_models = {
         'Route': Route,
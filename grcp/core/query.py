@@ -1,9 +1,42 @@
 """A query interface to Cypher. Used to construct a Cypher query
 """
+import functools
+
 from . import model
 
 ALLOWED_OPS = frozenset(['=', '<>', '<', '<=', '>', '>=', 'in'])
 
+
+def _quote(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _list_literal(value):
+    return '[%s]' % ', '.join([to_literal(v) for v in value])
+
+
+# how a value of each type is written in a Cypher statement
+_FORMATTERS = {
+    str: _quote,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+    list: _list_literal,
+    tuple: _list_literal,
+    set: _list_literal,
+    frozenset: _list_literal,
+}
+
+
+def to_literal(value):
+    """Return value as a Cypher literal. Ex: 'a"b' -> '"a\\"b"', [1, None] -> '[1, null]'"""
+    formatter = _FORMATTERS.get(type(value))
+    if formatter is not None:
+        return formatter(value)
+    if isinstance(value, str):
+        return _quote(value)
+    return str(value)
+
+
 class NodeBase(object):
     """Base class for a filter"""
     def __eq__(self, other):
@@ -34,8 +67,7 @@ class FilterNode(NodeBase):
 
     def to_cypher(self):
         out = '{name} {op} {value}'
-        value = '"%s"' % self._value if type(self._value)==str else self._value
-        return out.format(name=self._name, op=self._opsymbol, value=value)
+        return out.format(name=self._name, op=self._opsymbol, value=to_literal(self._value))
 
 
 class ConjunctionNode(NodeBase):
@@ -49,11 +81,7 @@ class ConjunctionNode(NodeBase):
         return self
 
     def to_cypher(self):
-        s = ''
-        for node in self._nodes:
-            s += 'AND (%s) ' % node.to_cypher()
-        s = s[3:]
-        return s
+        return ' AND '.join(['(%s)' % node.to_cypher() for node in self._nodes])
 
 
 class DisjunctionNode(NodeBase):
@@ -64,11 +92,7 @@ class DisjunctionNode(NodeBase):
         return self
 
     def to_cypher(self):
-        s = ''
-        for node in self._nodes:
-            s += 'OR (%s) ' % node.to_cypher()
-        s = s[2:]
-        return s
+        return ' OR '.join(['(%s)' % node.to_cypher() for node in self._nodes])
 
     __repr__ = to_cypher
 
@@ -80,15 +104,13 @@ OR = DisjunctionNode
 class FilterInclude(FilterNode):
     def to_cypher(self):
         out = '{value} {op} {name}'
-        value = '"%s"' % self._value if type(self._value)==str else self._value
-        return out.format(name=self._name, op=self._opsymbol, value=value)
+        return out.format(name=self._name, op=self._opsymbol, value=to_literal(self._value))
 
 
 class FilterExclude(FilterNode):
     def to_cypher(self):
         out = 'NOT {value} {op} {name}'
-        value = '"%s"' % self._value if type(self._value)==str else self._value
-        return out.format(name=self._name, op=self._opsymbol, value=value)
+        return out.format(name=self._name, op=self._opsymbol, value=to_literal(self._value))
 
 
 class PropertyOrder(NodeBase):
@@ -108,15 +130,70 @@ class PropertyOrder(NodeBase):
         return s
 
 
+@functools.lru_cache(maxsize=64)
+def _path_template(src_label, dst_label, early_filter):
+    """Return the statement matching the paths from src_label to dst_label nodes
+    with {where} and {sort} left to fill in. It only depends on the labels and the
+    early filter, whose values are query parameters, so it is built once per shape."""
+    if early_filter:
+        early_filter = ' WHERE ' + early_filter
+    else:
+        early_filter = ''
+    qry = 'MATCH (src: {src_kind} {state:"up"}), (dst: {dst_kind} {state:"up"}), '\
+          '(src)-[session:{in_kind}*0..1 {state:"up"}]-(ingress:{ingress_kind} {state:"up"}), '\
+          '(ingress)-[intra:{intra_kind}*0..1 {state:"up"}]->(egress:{egress_kind} {state:"up"}), '\
+          '(egress)-[inter:{inter_kind} {state:"up"}]->(neigh:{neigh_kind} {state:"up"}), '\
+          '(neigh)-[route:{route_kind} {state:"up"}]->(dst) {early_filter} '\
+          'WITH src, dst, neigh, ingress, egress, inter, route, intra[0] as intra '\
+          'WITH {src: src, dst: dst, {intra}, {inter}, {route}, '\
+          'ingress: {id: ingress.routerid, vlan_vid: intra.vlan_vid, label: ingress.label, dp_id: ingress.dp_id}, '\
+          'egress: {id: egress.routerid, vlan_vid: inter.vlan_vid, label: egress.label, dp_id: egress.dp_id}, '\
+          'neighbor: {id: neigh.nexthop, pathid: inter.pathid} } '\
+          'AS {name} {where} RETURN {name} {sort}'
+
+    qry = qry.replace('{early_filter}', early_filter)
+    intra_props = []
+    inter_props = []
+    route_props = []
+    for name, prop in model.Path._SUPPORTED_PROPERTIES.items():
+        if 'intra' in name:
+            intra_props.append((name, prop))
+        elif 'inter' in name:
+            inter_props.append((name, prop))
+        elif 'route' in name:
+            route_props.append((name, prop))
+    for rep, kind, props in [
+            ('{intra}', 'intra', intra_props),
+            ('{inter}', 'inter', inter_props),
+            ('{route}', 'route', route_props)]:
+        prop_str = ','.join(['%s: %s.%s' % (name, kind, prop._name) for name, prop in props])
+        qry = qry.replace(rep, prop_str)
+
+    for (name, kind) in [
+            ('{src_kind}', src_label),
+            ('{dst_kind}', dst_label),
+            ('{ingress_kind}', model.Border.__name__),
+            ('{in_kind}', model.Session.__name__),
+            ('{intra_kind}', model.IntraLink.__name__),
+            ('{egress_kind}', model.Border.__name__),
+            ('{inter_kind}', model.InterEgress.__name__),
+            ('{neigh_kind}', model.Nexthop.__name__),
+            ('{route_kind}', model.Route.__name__),]:
+        kind = kind or ''
+        qry = qry.replace(name, kind)
+    return qry.replace('{name}', model.Path.__name__)
+
+
 class Query(object):
     """Represent a Cypher query expression."""
 
     def __init__(self, gdb, kind=None, filters=None, orders=None,
-                 src_label=None, dst_label=None, early_filter=None):
+                 src_label=None, dst_label=None, early_filter=None, params=None):
         """
         A query is a Cypher statement to be executed on a Cypher graph database.
         :param gdb: instance of grcp.core.Neo4j
         :param kind: model class
+        :param params: values of the $parameters used in early_filter
         """
         self.gdb = gdb
         self.kind = kind
@@ -125,6 +202,7 @@ class Query(object):
         self.early_filter = early_filter
         self.src_label = src_label
         self.dst_label = dst_label
+        self.params = params or {}
 
     def _to_cypher(self, limit=None, count=False):
         kind = self.kind.__name__
@@ -136,65 +214,20 @@ class Query(object):
             sort_str = ''
         qry = ''
         if self.kind == model.Path:
-            early_filter = ''
-            if self.early_filter:
-                early_filter = ' WHERE ' + self.early_filter
-            qry = 'MATCH (src: {src_kind} {state:"up"}), (dst: {dst_kind} {state:"up"}), '\
-                  '(src)-[session:{in_kind}*0..1 {state:"up"}]-(ingress:{ingress_kind} {state:"up"}), '\
-                  '(ingress)-[intra:{intra_kind}*0..1 {state:"up"}]->(egress:{egress_kind} {state:"up"}), '\
-                  '(egress)-[inter:{inter_kind} {state:"up"}]->(neigh:{neigh_kind} {state:"up"}), '\
-                  '(neigh)-[route:{route_kind} {state:"up"}]->(dst) {early_filter} '\
-                  'WITH src, dst, neigh, ingress, egress, inter, route, intra[0] as intra '\
-                  'WITH {src: src, dst: dst, {intra}, {inter}, {route}, '\
-                  'ingress: {id: ingress.routerid, vlan_vid: intra.vlan_vid, label: ingress.label, dp_id: ingress.dp_id}, '\
-                  'egress: {id: egress.routerid, vlan_vid: inter.vlan_vid, label: egress.label, dp_id: egress.dp_id}, '\
-                  'neighbor: {id: neigh.nexthop, pathid: inter.pathid} } '\
-                  'AS {name} {where} RETURN {name} {sort}'
-
-            qry = qry.replace('{early_filter}', early_filter)
-            intra_props = []
-            inter_props = []
-            route_props = []
-            for name, prop in model.Path._SUPPORTED_PROPERTIES.items():
-                if 'intra' in name:
-                    intra_props.append((name, prop))
-                elif 'inter' in name:
-                    inter_props.append((name, prop))
-                elif 'route' in name:
-                    route_props.append((name, prop))
-            for rep, kind, props in [
-                    ('{intra}', 'intra', intra_props),
-                    ('{inter}', 'inter', inter_props),
-                    ('{route}', 'route', route_props)]:
-                prop_str = ','.join(['%s: %s.%s' % (name, kind, prop._name) for name, prop in props])
-                qry = qry.replace(rep, prop_str)
-
-            for (name, kind) in [
-                    ('{src_kind}', self.src_label),
-                    ('{dst_kind}', self.dst_label),
-                    ('{ingress_kind}', model.Border.__name__),
-                    ('{in_kind}', model.Session.__name__),
-                    ('{intra_kind}', model.IntraLink.__name__),
-                    ('{egress_kind}', model.Border.__name__),
-                    ('{inter_kind}', model.InterEgress.__name__),
-                    ('{neigh_kind}', model.Nexthop.__name__),
-                    ('{route_kind}', model.Route.__name__),]:
-                kind = kind or ''
-                qry = qry.replace(name, kind)
+            qry = _path_template(self.src_label, self.dst_label, self.early_filter)
             qry = qry.replace('{where}', filter_str)
             qry = qry.replace('{sort}', sort_str)
-            qry = qry.replace('{name}', model.Path.__name__)
 
         elif issubclass(self.kind, model.Node):
             if filter_str and self.early_filter:
-                filter_str = ' AND ' + self.early_filter
+                filter_str += ' AND ' + self.early_filter
             elif self.early_filter:
                 filter_str = ' WHERE ' + self.early_filter
             qry = 'MATCH ({name}:{kind}) {where} RETURN {name} {sort}'
             qry = qry.format(name=kind, kind=kind, where=filter_str, sort=sort_str)
         elif issubclass(self.kind, model.Edge):
             if filter_str and self.early_filter:
-                filter_str = ' AND ' + self.early_filter
+                filter_str += ' AND ' + self.early_filter
             elif self.early_filter:
                 filter_str = ' WHERE ' + self.early_filter
             src_label = ':' + self.src_label if self.src_label else ''
@@ -230,7 +263,8 @@ class Query(object):
             pred = ConjunctionNode(*preds)
         return self.__class__(self.gdb, self.kind, filters=pred,
                               orders=self.orders, early_filter=self.early_filter,
-                              src_label=self.src_label, dst_label=self.dst_label)
+                              src_label=self.src_label, dst_label=self.dst_label,
+                              params=self.params)
 
     def order(self, *nodes):
         if not nodes:
@@ -248,12 +282,23 @@ class Query(object):
                 self.orders.append(PropertyOrder(node._code_name))
         return self
 
-    def fetch(self, limit=None):
-        records = self.gdb.exec_query(self._to_cypher(limit))
+    def fetch(self, limit=None, ttl=None):
+        """Run the query. With ttl (seconds) the result may come from the cache of
+        recent reads; see Neo4J.exec_query_cached."""
+        if ttl:
+            records = self.gdb.exec_query_cached(self._to_cypher(limit), ttl=ttl, **self.params)
+        else:
+            records = self.gdb.exec_read(self._to_cypher(limit), **self.params)
         return [self.kind.neo4j_to_model(record) for record in records]
 
+    def iter(self, limit=None):
+        """Run the query and yield the results as their records are received,
+        without keeping them all in memory; see Neo4J.exec_query_stream."""
+        records = self.gdb.exec_query_stream(self._to_cypher(limit), **self.params)
+        for record in records:
+            yield self.kind.neo4j_to_model(record)
+
     def count(self):
         # TODO: to_cypher should return Cypher statement with COUNT
         qry = self._to_cypher(count=True)
-        record = self.gdb.exec_query(qry)
-        return len(list(record))
+        return len(self.gdb.exec_read(qry, **self.params))
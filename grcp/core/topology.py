@@ -1,11 +1,8 @@
-import eventlet
-eventlet.monkey_patch()
-
 import os
 import logging
 import collections
 
-from grcp.app_manager import AppBase
+from grcp.app_manager import AppBase, spawn
 from .controller import RouterController
 from .stats import PrometheusQuery
 from .event import EventBase
@@ -50,6 +47,7 @@ class EventLinkStatsChange(EventBase):
 
 
 class TopologyManager(AppBase):
+    __slots__ = ('prefixes', 'nexthops', 'controller', 'stats_collector')
 
     def __init__(self):
         super(TopologyManager, self).__init__()
@@ -72,11 +70,15 @@ class TopologyManager(AppBase):
     def clear(self):
         model.clear()
 
+    def stop(self):
+        super(TopologyManager, self).stop()
+        model.close()
+
     def start(self):
         super(TopologyManager, self).start()
         self.controller = RouterController(self)
-        eventlet.spawn(self.stats_collector.run)
-        return eventlet.spawn(self.controller)
+        spawn(self.stats_collector.run)
+        return spawn(self.controller)
 
     def link_stats_change_handler(self, link):
         ev = EventLinkStatsChange(link)
@@ -123,9 +125,9 @@ class TopologyManager(AppBase):
             return peer
         return None
 
-    def peer_down(self, peer_ip):
+    def peer_down(self, peer_ip, local_ip=None):
         logger.debug('peer down: %s' % peer_ip)
-        peer = model.Neighbor.update(peer_ip, **{'state': 'down'})
+        peer = model.Neighbor.update(peer_ip, {'state': 'down'})
         if peer:
             logger.info('updated peer in database: %s' % peer_ip)
             self.send_event_to_observers(EventPeerDown(peer))
@@ -137,7 +139,7 @@ class TopologyManager(AppBase):
         if prefix not in self.prefixes:
             self.create_prefix(prefix)
 
-        if nexthop in self.prefixes[prefix]:
+        if nexthop in self.prefixes.get(prefix, ()):
             route = model.Route.update(nexthop, prefix, state='up')
         else:
             route = model.Route.get_or_create(
@@ -151,6 +153,56 @@ class TopologyManager(AppBase):
             return route
         logger.error('failed to create route in db: %s via %s' % (prefix, nexthop))
 
+    def routes_up(self, routes):
+        """Batch version of route_up. routes is a list of (nexthop, prefix, attrs)
+        where attrs are the keyword arguments of route_up. New routes, and their
+        nexthops and prefixes, are written with one query each in one transaction.
+        Return the (nexthop, prefix, attrs) of the routes written."""
+        nexthops = set([nexthop for nexthop, _, _ in routes if nexthop not in self.nexthops])
+        prefixes = set([prefix for _, prefix, _ in routes if prefix not in self.prefixes])
+        new = []
+        new_routes = []
+        existing = []
+        for nexthop, prefix, attrs in routes:
+            # self.prefixes is only written once the routes are in the database
+            if nexthop in self.prefixes.get(prefix, ()):
+                existing.append((nexthop, prefix, attrs))
+            else:
+                properties = {'state': 'up', 'local_pref': 100, 'med': 0,
+                              'as_path': [], 'origin': 0}
+                properties.update(attrs)
+                new.append((nexthop, prefix, properties))
+                new_routes.append((nexthop, prefix, attrs))
+
+        created = []
+        with model.transaction():
+            if nexthops:
+                model.Nexthop.get_or_create_many(nexthops, state='up')
+            if prefixes:
+                model.Prefix.get_or_create_many(prefixes, state='up')
+            if new:
+                created = model.Route.get_or_create_many(new)
+        # keyed like the checks above by the nexthop of the message, which may not be
+        # written the way the database stores it
+        self.nexthops.update(nexthops)
+        written = [(nexthop, prefix, attrs) for nexthop, prefix, attrs in existing
+                   if self.route_up(nexthop, prefix, **attrs)]
+        if not new:
+            return written
+        if len(created) == len(new):
+            for nexthop, prefix, _ in new:
+                self.prefixes[prefix].add(nexthop)
+            written.extend(new_routes)
+        else:
+            # the records cannot be told apart, so none is marked as known; the next
+            # update of each route merges it again
+            logger.error('failed to create %d of %d routes in db' % (
+                len(new) - len(created), len(new)))
+        for route in created:
+            logger.info('added route to db: %s' % route.prefix)
+            self.send_event_to_observers(EventRouteAdd(route))
+        return written
+
     def route_down(self, peer_ip, nexthop, prefix):
         """ simply mark the Route relationship as down"""
         route = model.Route.update(nexthop, prefix, **{'state': 'down'})
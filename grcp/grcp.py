@@ -2,6 +2,9 @@
 """
 Main programm
 """
+import eventlet
+eventlet.monkey_patch()
+
 import os
 import sys
 import time
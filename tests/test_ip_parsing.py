@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+import unittest
+import ipaddress
+import random
+
+from grcp.core import model
+
+
+def _result(func, value):
+    """Return ('ok', str) or ('error', None) of calling func with value."""
+    try:
+        return ('ok', str(func(value)))
+    except ValueError:
+        return ('error', None)
+
+
+class IPParsingTest(unittest.TestCase):
+    """The fast paths of _parse_ip and _parse_prefix must agree with ipaddress.
+    No database is needed."""
+
+    ADDRESSES = [
+            '1.2.3.4', '0.0.0.0', '255.255.255.255', '256.1.1.1', '1.2.3', '1.2.3.4.5',
+            '1..3.4', '0x1.2.3.4', '', ' ', '1.2.3.4 ', ' 1.2.3.4', '1.2.3.4\n', '1.2.3.4/32',
+            '::', '::1', '2001:db8::1', '2001:DB8::1', 'FFFF::', '2001:0db8::1',
+            '2001:db8:0:0:0:0:0:1', '2001:db8:0:0:1:0:0:1', '2001:0:0:1:0:0:0:1',
+            '1:2:3:4:5:6:7:8', '1:2:3:4:5:6:7::', '::2:3:4:5:6:7:8', '1::2:3:4:5:6:7:8',
+            '::ffff:1.2.3.4', '::1.2.3.4', '64:ff9b::1.2.3.4', '::FFFF:102:304',
+            '2001:db8::1 ', ' 2001:db8::1', '2001:db8:::1', 'fe80::1%eth0', '12345::1',
+            ]
+
+    PREFIXES = [
+            '10.0.0.0/8', '10.0.0.1/8', '0.0.0.0/0', '1.0.0.0/0', '1.2.3.4/32', '1.2.3.4',
+            '1.2.3.0/24 ', ' 1.2.3.0/24', '1.2.3.0/024', '1.2.3.0/33', '1.2.3.0/', '/24',
+            '1.2.3.0/-1', '1.2.3.0/+24', '1.2.3.0/255.255.255.0', '1.2.3.0/24/24',
+            '::/0', '1::/0', '::1/128', '::1', '2001:db8::/32', '2001:DB8::/32',
+            '2001:db8::1/32', '2001:db8::1/128', '2001:db8::/129', '2001:db8::/032',
+            '2001:0db8::/32', '::ffff:1.2.3.0/120', '::ffff:1.2.3.4/128', '2001:db8::/',
+            '2001:db8::/32 ', ' 2001:db8::/32', 'FFFF::/16',
+            ]
+
+    # leading zeros in IPv4 are rejected; ipaddress only does so since Python 3.9.5
+    LEADING_ZEROS = ['01.2.3.4', '1.2.3.04', '001.2.3.4', '01.2.3.0/24']
+
+    def assertSameAsIPAddress(self, func, reference, value):
+        self.assertEqual(_result(func, value), _result(reference, value), repr(value))
+
+    def test_addresses(self):
+        for value in self.ADDRESSES:
+            self.assertSameAsIPAddress(model._parse_ip, ipaddress.ip_address, value)
+
+    def test_prefixes(self):
+        for value in self.PREFIXES:
+            self.assertSameAsIPAddress(model._parse_prefix, ipaddress.ip_network, value)
+
+    def test_leading_zeros(self):
+        for value in self.LEADING_ZEROS:
+            func = model._parse_prefix if '/' in value else model._parse_ip
+            self.assertRaises(ValueError, func, value)
+
+    def test_canonical_ipv6(self):
+        for value in ('::', '::1', '2001:db8::1', '1:2:3:4:5:6:7:8', 'ffff::'):
+            self.assertEqual(model._canonical_ipv6(value), ipaddress.IPv6Address(value).packed)
+        for value in ('2001:DB8::1', '2001:0db8::1', '2001:db8:0:0:0:0:0:1', '::ffff:1.2.3.4',
+                      '::1.2.3.4', '2001:db8::1 ', '2001:db8:::1', '1.2.3.4'):
+            self.assertIsNone(model._canonical_ipv6(value), repr(value))
+
+    def test_random(self):
+        rand = random.Random(0)
+        for _ in range(2000):
+            if rand.random() < 0.5:
+                bits, length = 32, rand.randint(0, 32)
+                address = ipaddress.IPv4Address(rand.getrandbits(bits))
+            else:
+                bits, length = 128, rand.randint(0, 128)
+                # runs of zero groups exercise the :: compression
+                groups = [rand.choice([0, 0, rand.getrandbits(16)]) for _ in range(8)]
+                address = ipaddress.IPv6Address(sum(g << (16 * i) for i, g in enumerate(groups)))
+            for value in (str(address), str(address).upper(), address.exploded):
+                self.assertSameAsIPAddress(model._parse_ip, ipaddress.ip_address, value)
+            network = ipaddress.ip_network('%s/%d' % (address, length), strict=False)
+            for value in (str(network), '%s/%d' % (address, length), str(network).upper()):
+                self.assertSameAsIPAddress(model._parse_prefix, ipaddress.ip_network, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
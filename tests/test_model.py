@@ -37,7 +37,7 @@ class ModelBasicTest(unittest.TestCase):
     def put_and_test(self, entity):
         entity_ret = entity.put()
         self.assertTrue(entity_ret is not None)
-        for name in entity._properties.keys():
+        for name in entity.properties.keys():
             self.assertEqual(getattr(entity, name), getattr(entity_ret, name))
         return entity_ret
 
@@ -147,6 +147,52 @@ class ModelBasicTest(unittest.TestCase):
         query = query.filter(model.Path.inter_bw >= 5, model.Path.route_pref <= 100)
         self.get_and_test(query, expected=1)
 
+    def test_create_node_labels(self):
+        gdb = model.Model._gdb
+        node = gdb.create_node('Prefix', {'prefix': '1.0.0.0/24'},
+                               {'prefix': '1.0.0.0/24', 'uid': '1'})
+        self.assertEqual(set(node.labels), {'Prefix'})
+        node = gdb.create_node(['Router', 'Border'], {'routerid': '1.1.1.1'},
+                               {'routerid': '1.1.1.1', 'uid': '2'})
+        self.assertEqual(set(node.labels), {'Router', 'Border'})
+
+    def test_put_many(self):
+        prefixes = model.Prefix.put_many(
+                [model.Prefix(prefix='%d.0.0.0/24' % i) for i in range(1, 4)])
+        self.assertEqual(len(prefixes), 3)
+        nexthop = self.put_and_test(model.Nexthop(nexthop='10.0.0.1'))
+        routes = model.Route.put_many([
+                model.Route(src=nexthop.uid, dst=prefix.uid, prefix=prefix.prefix)
+                for prefix in prefixes])
+        self.assertEqual(sorted([route.dst for route in routes]),
+                         sorted([prefix.uid for prefix in prefixes]))
+        self.assertEqual(len(list(model.Route.query().fetch())), 3)
+
+    def test_mapping_get_or_create_many(self):
+        model.Border.get_or_create(routerid='1.1.1.1', state='up')
+        model.Neighbor.get_or_create(peer_ip='3.3.3.3', peer_as=1, state='up')
+        for i in range(1, 3):
+            model.Prefix.get_or_create(prefix='%d.0.0.0/24' % i, state='up')
+        path = {'ingress': '1.1.1.1', 'egress': '1.1.1.1', 'neighbor': '10.0.0.1',
+                'pathid': '1', 'state': 'up'}
+        mappings = model.Mapping.get_or_create_many([
+                ('1.1.1.1', '1.0.0.0/24', path, False),
+                ('1.1.1.1', '2.0.0.0/24', path, False),
+                ('3.3.3.3', '1.0.0.0/24', path, True)])
+        self.assertEqual(len(mappings), 3)
+        self.assertNotIn('prefix', path)
+        self.assertEqual(len(list(model.Mapping.query().fetch())), 3)
+        self.assertEqual(len(model.Mapping.find_by_pairs(
+                [('1.1.1.1', '1.0.0.0/24'), ('3.3.3.3', '1.0.0.0/24')])), 2)
+
+    def test_find_many(self):
+        prefixes = model.Prefix.put_many(
+                [model.Prefix(prefix='%d.0.0.0/24' % i) for i in range(1, 4)])
+        found = model.Prefix.find_many(['1.0.0.0/24', '2.0.0.0/24', '9.0.0.0/24'], key='prefix')
+        self.assertEqual(sorted([prefix.prefix for prefix in found]), ['1.0.0.0/24', '2.0.0.0/24'])
+        found = model.Prefix.find_many([prefix.uid for prefix in prefixes])
+        self.assertEqual(len(found), 3)
+
     def test_model_link_delete(self):
         border1 = self.put_and_test(model.Border(routerid='1.1.1.1'))
         border2 = self.put_and_test(model.Border(routerid='2.2.2.2'))